@@ -0,0 +1,157 @@
+"""
+Benchmarks for the scheduler on synthetic task graphs.
+
+Run from the top of the project::
+
+    python -m benchmarks.scheduler
+    python -m benchmarks.scheduler --shapes chain,random --sizes 1000,100000 --jobs 4
+
+Every case runs in a new process so the peak memory is its own.
+"""
+from __future__ import print_function
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+from chimney.compilers import Compiler
+from chimney.executor import DelayedThreadPoolExecutor
+from chimney.scheduler import Scheduler
+
+
+class noop(Compiler):
+    def run(self):
+        pass
+
+
+def name(i):
+    return 'static/{0}/{1}.js'.format(i % 100, i)
+
+
+def wide(size):
+    """
+    One task that everything else depends on
+    """
+    tasks = [noop(name(0), 'root.coffee')]
+    tasks += [noop(name(i), name(0)) for i in range(1, size)]
+    return tasks
+
+
+def chain(size):
+    """
+    Every task depends on the one before it
+    """
+    tasks = [noop(name(0), 'root.coffee')]
+    tasks += [noop(name(i), name(i - 1)) for i in range(1, size)]
+    return tasks
+
+
+def diamond(size):
+    """
+    A chain of diamonds: a task, two tasks depending on it, and one depending on both of those
+    """
+    tasks = [noop(name(0), 'root.coffee')]
+    i = 1
+    while i + 2 < size:
+        top = name(i - 1)
+        tasks.append(noop(name(i), top))
+        tasks.append(noop(name(i + 1), top))
+        tasks.append(noop(name(i + 2), [name(i), name(i + 1)]))
+        i += 3
+    tasks += [noop(name(j), name(j - 1)) for j in range(i, size)]
+    return tasks
+
+
+def random_dag(size, seed=0):
+    """
+    Every task depends on up to three earlier tasks and a source file
+    """
+    rand = random.Random(seed)
+    tasks = []
+    for i in range(size):
+        deps = ['{0}.coffee'.format(i)]
+        if i:
+            deps += sorted(set(name(rand.randrange(i)) for _ in range(rand.randint(0, 3))))
+        tasks.append(noop(name(i), deps))
+    return tasks
+
+
+SHAPES = {
+    'wide': wide,
+    'chain': chain,
+    'diamond': diamond,
+    'random': random_dag,
+}
+
+
+def measure(shape, size, jobs=4):
+    """
+    Run one case and return its timings in seconds and peak memory in kilobytes
+    """
+    tasks = SHAPES[shape](size)
+
+    started = time.time()
+    scheduler = Scheduler().load(tasks)
+    load = time.time() - started
+
+    started = time.time()
+    ordered = list(scheduler.targets.toposort())
+    toposort = time.time() - started
+    assert len(ordered) == len(tasks)
+
+    started = time.time()
+    runners = scheduler.run()
+    run = time.time() - started
+
+    executor = DelayedThreadPoolExecutor(jobs)
+    started = time.time()
+    for runner in reversed(list(runners.values())):
+        runner.schedule(executor)
+    executor.wait()
+    dispatch = time.time() - started
+    executor.shutdown()
+    assert all(r.future.done() and not r.future.exception() for r in runners.values())
+
+    return {
+        'shape': shape,
+        'size': size,
+        'load': load,
+        'toposort': toposort,
+        'run': run,
+        'dispatch': dispatch,
+        # ru_maxrss is in kilobytes on linux and bytes on OS X
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--shapes', default=','.join(sorted(SHAPES)),
+                        help='comma separated graph shapes: %(default)s')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated task counts')
+    parser.add_argument('--jobs', type=int, default=4, help='executor threads')
+    parser.add_argument('--case', nargs=2, metavar=('SHAPE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(measure(args.case[0], int(args.case[1]), args.jobs)))
+        return
+
+    print('{0:>8} {1:>7} {2:>9} {3:>9} {4:>9} {5:>13} {6:>9}'.format(
+        'shape', 'tasks', 'load s', 'sort s', 'run s', 'dispatch us', 'peak MB'))
+    for shape in args.shapes.split(','):
+        for size in args.sizes.split(','):
+            out = subprocess.check_output([sys.executable, '-m', 'benchmarks.scheduler',
+                                           '--jobs', str(args.jobs), '--case', shape, size])
+            result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+            print('{shape:>8} {size:>7} {load:>9.3f} {toposort:>9.3f} {run:>9.3f} {per_task:>13.1f} {mb:>9.1f}'.format(
+                per_task=result['dispatch'] / result['size'] * 1000000,
+                mb=result['maxrss'] / 1024.0,
+                **result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
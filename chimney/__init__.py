@@ -1,2 +1,2 @@
-from api import make, watch
+from api import make, plan, watch
 import compilers
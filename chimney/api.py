@@ -3,9 +3,17 @@ import multiprocessing
 import os
 import logging
 import six
-import time
-from chimney.scheduler import Scheduler, Runner
-from chimney.watch import Watcher
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from chimney.cache import ArtifactCache
+from chimney.db import BuildDatabase
+from chimney.index import DirectoryIndex, StatCache
+from chimney.jobserver import JobServer
+from chimney.reactor import AsyncExecutor, CommandReactor
+from chimney.scheduler import Scheduler
+from chimney.trace import NullTracer, Tracer
+from chimney.watch import ChangeQueue, Observation, Watcher, net_changes, watch_directories
+from chimney.workers import WorkerPool
 from executor import DelayedThreadPoolExecutor
 
 
@@ -26,58 +34,176 @@ class Maker(object):
         ``tasks`` - A list of Compiler instances to run
         ``directory`` - Must be the top level of the project. All files will be relative to this path.
             Defaults to the current directory.
+        ``executor`` - ``'thread'`` (the default) runs tasks on threads. ``'process'`` runs every task
+            in a pool of worker processes, which is otherwise only done for compilers that set ``process``.
+            ``'async'`` runs the commands of compilers that implement ``commands()`` from a single
+            thread, up to ``jobs`` at a time, and only uses threads for other compilers.
+        ``trace`` - A file to write a timeline of the build to, in Chrome's trace event format.
+        ``debounce`` - Seconds to wait for a burst of changes to settle before rebuilding in watch mode.
+        ``resources`` - Limits of the resources compilers declare in ``resources``, like
+            ``{'memory': 4096, 'node': 4}``. ``cpu`` defaults to ``jobs``.
+        ``jobserver`` - ``True`` to start a GNU make jobserver for ``jobs`` jobs, which commands like a
+            nested ``make`` share with chimney. By default chimney only takes part in the jobserver of
+            a parent make, if there is one. ``False`` ignores jobservers.
+        ``targets`` - Output files to build. Only the tasks producing them and the tasks they depend on
+            run, also when rebuilding in watch mode. Defaults to every task.
+        ``database`` - Path of the build database used to skip tasks whose inputs and flags haven't
+            changed. Defaults to ``.chimney/db`` in ``directory``. ``None`` falls back to comparing
+            modification times.
+        ``cache`` - A directory, like one shared over NFS, to keep the outputs of tasks in by the
+            contents of their inputs. Tasks built from the same inputs before are restored from
+            there instead of running. Also takes an ArtifactCache with another backend.
         """
         self.tasks = tasks
         self.directory = kw.pop('directory', None) or os.path.abspath(os.path.curdir)
         self.jobs = int(kw.pop('jobs', multiprocessing.cpu_count() * 1.5))
+        self.database = kw.pop('database', os.path.join(self.directory, '.chimney', 'db'))
+        if isinstance(self.database, six.string_types):
+            self.database = BuildDatabase(self.database)
+        self.cache = kw.pop('cache', None)
+        if isinstance(self.cache, six.string_types):
+            self.cache = ArtifactCache(self.cache, self.directory)
+        self.mode = kw.pop('executor', 'thread')
+        if self.mode not in ('thread', 'process', 'async'):
+            raise ValueError(u'Unknown executor: {0}'.format(self.mode))
+        if self.mode == 'async' and os.name == 'nt':
+            raise ValueError(u'The async executor needs select() on pipes, which Windows lacks')
+        self.trace = kw.pop('trace', None)
+        self.tracer = Tracer() if self.trace else NullTracer()
+        self.debounce = float(kw.pop('debounce', .05))
+        self.resources = kw.pop('resources', None)
+        self.targets = kw.pop('targets', None)
+        if isinstance(self.targets, six.string_types):
+            self.targets = [self.targets]
+        self.jobserver = kw.pop('jobserver', None)
+        if self.jobserver is not False:
+            jobserver = JobServer.from_environ()
+            if jobserver is None and self.jobserver:
+                jobserver = JobServer.create(self.jobs)
+            self.jobserver = jobserver
+        else:
+            self.jobserver = None
         self.watcher = None
         # observed changes
-        self.changes = []
+        self.changes = ChangeQueue()
 
         if kw:
             raise TypeError('Unknown keyword arguments: {0}'.format(', '.join(kw.keys())))
 
+        # directory listings shared by the glob patterns of all tasks
+        self.index = DirectoryIndex()
+        # file stats shared by the up to date checks of a build
+        self.stats = StatCache()
         for task in self.tasks:
             task.maker = self
 
-        self.executor = DelayedThreadPoolExecutor(self.jobs)
+        self.scheduler = None
+        self.by_source = {}
+        # the latest runner of every task in watch mode, by output file
+        self.runners = {}
+        # absolute paths modified along with the changes that caused a reload
+        self.modified = []
+        self.executor = DelayedThreadPoolExecutor(self.jobs, self.resources)
+        self.executor.jobserver = self.jobserver
+        if self.mode == 'async':
+            self.executor = AsyncExecutor(self.executor, CommandReactor(self.jobs, self.jobserver))
+        self.executor.tracer = self.tracer
+        self.workers = WorkerPool(self.jobs)
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+        # inputs tasks discovered while running, added to the graph by the main thread
+        self._discovered = []
+        self._discovered_lock = threading.Lock()
         super(Maker, self).__init__()
 
     def execute(self):
-        runners = Scheduler().load(self.tasks).run()
-        # schedule all of the runners
-        for runner in six.itervalues(runners):
-            runner.schedule(self.executor)
-
+        self.start_processes()
+        scheduler = Scheduler(self.durations()).load(self.tasks, self.implicit())
+        self.schedule(scheduler.run(self.selected(scheduler)))
         self.executor.wait()
+        self.save()
 
-    def watch(self, reload_patterns=None, restart_patterns=None):
-        scheduler = Scheduler().load(self.tasks)
-        runners = scheduler.run()
+    def plan(self):
+        """
+        Return what a build would do without running anything: a list of ``(task, reason)``
+        for every task that would run, in the order they would run.
 
-        # schedule all of the runners
-        self.by_source = {}
-        for runner in six.itervalues(runners):
+        Every file is stat'ed once, however many tasks use it. A task also runs when a task it
+        depends on does. Nothing is written, not even to the build database.
+        """
+        if self.database is not None:
+            readonly, self.database.readonly = self.database.readonly, True
+            try:
+                return self._plan()
+            finally:
+                self.database.readonly = readonly
+        return self._plan()
+
+    def _plan(self):
+        scheduler = Scheduler(self.durations()).load(self.tasks, self.implicit())
+        graph = scheduler.targets
+        tasks = list(graph.toposort(self.selected(scheduler)))
+
+        stats = StatCache()
+        stats.prefetch([f for task in tasks for f in graph.sources(task)] +
+                       [task.output_file for task in tasks])
+        planned = []
+        stale = set()
+        for task in tasks:
+            rebuilt = [dep for dep in graph.sources(task) if dep in stale]
+            if rebuilt:
+                reason = u'{0} will be rebuilt'.format(rebuilt[0])
+            else:
+                reason = task.out_of_date(stats)[0]
+            if reason is not None:
+                stale.add(task.output_file)
+                planned.append((task, reason))
+        return planned
+
+    def schedule(self, runners):
+        """
+        Schedule runners returned by ``Scheduler.run``
+        """
+        # every build stats the files again, anything may have changed since the last one. runners
+        # of an earlier build still writing their outputs forget them, which the prefetch can't undo
+        self.stats.clear()
+        self.stats.prefetch(f for runner in six.itervalues(runners) for f in runner.task.dependent)
+        # dependents go first so they are waiting before anything they depend on can finish
+        for runner in reversed(list(six.itervalues(runners))):
             runner.schedule(self.executor)
-            for dep in runner.task.dependent:
-                abs = os.path.abspath(dep)
-                if abs not in self.by_source:
-                    self.by_source[abs] = set([runner.task])
-                else:
-                    self.by_source[abs].add(runner.task)
 
-        self.executor.wait()
+    def watch(self, reload_patterns=None, restart_patterns=None, include=None, exclude=None, reload=None):
+        """
+        Execute all tasks, then watch for changes and rebuild what they affect.
 
-        def change_handler(obs):
-            self.changes.append(obs)
-        self.watcher = Watcher(change_handler)
+        ``reload`` - a function returning a new list of tasks. If given, files being created or
+            deleted reload the tasks in place with ``reload()``. Otherwise ``watch`` returns
+            ``Maker.RELOAD`` and the caller has to start over.
+        """
+        self.start_processes()
+        self.load(self.tasks)
+        self.schedule(self.scheduler.run(self.selected()))
+        self.executor.wait()
+        self.save()
+        self.update_discovered()
+
+        self.watcher = Watcher(
+            self.observed,
+            path=self.watch_directories(),
+            recursive=False,
+            include=include,
+            exclude=exclude,
+            ignore=self.outputs(),
+        )
         log.info('Watching for changes. Control-C to cancel')
 
         try:
             while self.sleep():
                 ret = self.process_changes(reload_patterns, restart_patterns)
                 if ret == Maker.RELOAD:
-                    return Maker.RELOAD
+                    if reload is None:
+                        return Maker.RELOAD
+                    self.reload(reload())
                 if ret == Maker.EXIT:
                     raise SystemExit()
         except KeyboardInterrupt:
@@ -87,46 +213,264 @@ class Maker(object):
 
         return Maker.STOP_WATCHING
 
+    def load(self, tasks):
+        """
+        Build the task graph and the index of tasks by dependency
+        """
+        self.tasks = tasks
+        for task in self.tasks:
+            task.maker = self
+        self.scheduler = Scheduler(self.durations()).load(self.tasks, self.implicit())
+
+        self.by_source = {}
+        for task in self.tasks:
+            for dep in self.scheduler.targets.sources(task):
+                abs = os.path.abspath(dep)
+                if abs not in self.by_source:
+                    self.by_source[abs] = set([task])
+                else:
+                    self.by_source[abs].add(task)
+
+    def selected(self, scheduler=None):
+        """
+        Return the tasks needed for ``targets``, or None for all of them
+        """
+        if self.targets is None:
+            return None
+        return (scheduler or self.scheduler).targets.upstream(self.targets)
+
+    def discovered(self, task, files):
+        """
+        Called by ``task`` after a run with the inputs it discovered
+        """
+        with self._discovered_lock:
+            self._discovered.append((task, files))
+
+    def update_discovered(self):
+        """
+        Add the inputs discovered since the last call to the task graph and the index of tasks
+        by dependency, so changes to them are noticed
+        """
+        with self._discovered_lock:
+            discovered, self._discovered = self._discovered, []
+
+        targets = self.scheduler.targets
+        changed = False
+        for task, files in discovered:
+            previous = targets.implicit.get(task.output_file, [])
+            if targets.tasks.get(task.output_file) is not task or previous == files:
+                # replaced by a reload or nothing new
+                continue
+            changed = True
+            for dep in previous:
+                self.by_source.get(os.path.abspath(dep), set()).discard(task)
+            targets.imply(task, files)
+            for dep in targets.implicit.get(task.output_file, []):
+                self.by_source.setdefault(os.path.abspath(dep), set()).add(task)
+
+        if changed and self.watcher:
+            self.watcher.watch(self.watch_directories())
+
+    def reload(self, tasks):
+        """
+        Replace the watched tasks with ``tasks``, only building the ones that are new or
+        have changed and everything downstream of them. The executor and watcher are reused.
+        """
+        current = dict((task.output_file, task) for task in self.tasks)
+        loaded = []
+        changed = []
+        for task in tasks:
+            # expand patterns with the index, which the watcher has kept up to date
+            task.maker = self
+            previous = current.get(task.output_file)
+            if previous is not None and same_task(previous, task):
+                # keep the instance that is already known
+                loaded.append(previous)
+            else:
+                loaded.append(task)
+                changed.append(task)
+
+        log.info('Reloaded %d tasks, %d new or changed', len(loaded), len(changed))
+        self.load(loaded)
+        # files modified in the batch that caused the reload
+        modified, self.modified = self.modified, []
+        changed.extend(task for task in self.using(modified) if task not in changed)
+        if changed:
+            self.rebuild(changed)
+
+        if self.watcher:
+            self.watcher.watch(self.watch_directories())
+            self.watcher.ignore = self.outputs()
+
+    def watch_directories(self):
+        # only watch where the dependencies are. the project directory is watched for build scripts
+        directories = set(watch_directories(self.by_source))
+        directories.add(self.directory)
+        # and wherever glob patterns looked, to see new matches
+        directories.update(d for d in self.index.directories if os.path.isdir(d))
+        return sorted(directories)
+
+    def observed(self, obs):
+        """
+        Called by the watcher for every change
+        """
+        replaced = obs.type == 'created' and (os.path.abspath(obs.path) in self.by_source or
+                                              self.index.lists(obs.path))
+        if obs.type in ('created', 'deleted', 'moved'):
+            # even a file saved by renaming over it, its deletion was taken from the listing
+            self.index.update(obs.path, obs.type)
+        if replaced:
+            # something was renamed over a file that was there already
+            obs = Observation(obs.path, 'modified')
+        self.stats.forget(obs.path)
+        self.changes.put(obs)
+
+    def outputs(self):
+        return set(os.path.abspath(output) for task in self.tasks for output in task.outputs())
+
     def process_changes(self, reload_patterns=None, restart_patterns=None):
-        batch = self.changes
-        self.changes = []
-        for obs in set(batch):
+        self.update_discovered()
+        batch = net_changes(self.changes.drain())
+        modified = []
+        reloading = False
+        for obs in batch:
             if obs.type in ('created', 'deleted',):
                 for p in restart_patterns or []:
                     if fnmatch.fnmatch(obs.path, p):
                         return Maker.EXIT
 
-                if reload_patterns is None:
+                if not reloading and (reload_patterns is None or
+                                      any(fnmatch.fnmatch(obs.path, p) for p in reload_patterns)):
                     log.info(u'File %s: %s, reloading', obs.type, obs.path)
-                    return Maker.RELOAD
+                    reloading = True
+                continue
 
-                for p in reload_patterns:
-                    if fnmatch.fnmatch(obs.path, p):
-                        log.info(u'File %s: %s, reloading', obs.type, obs.path)
-                        return Maker.RELOAD
+            if obs.type == 'modified':
+                modified.append(os.path.abspath(obs.path))
 
-            if obs.type != 'modified':
-                continue
+        if reloading:
+            # the rest of the batch is built by reload(), with the new tasks
+            self.modified.extend(modified)
+            return Maker.RELOAD
 
-            for task in (self.by_source.get(os.path.abspath(obs.path)) or []):
-                log.info('Detected %s: %s', obs.type, obs.path)
-                runner = Runner(task)
-                runner.schedule(self.executor)
+        changed = self.using(modified)
+        if changed:
+            self.rebuild(changed)
 
         return None
 
+    def using(self, paths):
+        """
+        Return the tasks depending on any of the absolute ``paths``
+        """
+        found = []
+        for path in paths:
+            for task in (self.by_source.get(path) or []):
+                log.info('Detected modified: %s', path)
+                if task not in found:
+                    found.append(task)
+        return found
+
+    def rebuild(self, changed):
+        """
+        Rebuild the ``changed`` tasks and everything downstream of them whose inputs change.
+
+        A task runs at most once at a time. If it is running, the new run waits for it to finish.
+        If the previous run hasn't started, the new one replaces it, so any number of changes
+        while a task runs add up to a single run after it.
+        """
+        tasks = self.scheduler.targets.downstream(changed)
+        if self.targets is not None:
+            selected = set(self.selected())
+            tasks = [task for task in tasks if task in selected]
+        runners = self.scheduler.run(tasks, changed)
+        for output_file, runner in six.iteritems(runners):
+            previous = self.runners.get(output_file)
+            if previous is not None and not previous.future.done():
+                if previous.replace():
+                    runner.take_over(previous, runners)
+                    previous = previous.follows
+                if previous is not None and not previous.future.done():
+                    runner.follows = previous
+            self.runners[output_file] = runner
+        self.schedule(runners)
+
     def sleep(self):
-        time.sleep(.1)
+        """
+        Block until there are changes to process
+        """
+        self.changes.wait(debounce=self.debounce)
         return True
 
+    def in_process(self, task):
+        """
+        Return True if ``task`` should run in a worker process
+        """
+        return self.mode == 'process' or task.process
+
+    def process_pool(self):
+        """
+        The pool of worker processes, started on first use. The threads of the executor still
+        track dependencies and wait for the results, so each thread needs at most one process.
+        """
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(self.jobs)
+            return self._process_pool
+
+    def start_processes(self):
+        """
+        Start the worker processes before anything runs if a task needs them. A process forked
+        while other threads are busy can inherit a lock one of them held, like the one of a
+        logging handler, and wait for it forever.
+        """
+        if any(self.in_process(task) for task in self.tasks):
+            # the pool starts all of its processes for the first call
+            self.process_pool().submit(int).result()
+
+    def durations(self):
+        return self.database.durations() if self.database is not None else None
+
+    def implicit(self):
+        return self.database.implicit if self.database is not None else None
+
+    def save(self):
+        if self.database is None:
+            return
+        try:
+            self.database.save()
+        except (IOError, OSError):
+            log.warning('Failed to save the build database', exc_info=True)
+
     def close(self):
         try:
             if self.watcher:
                 self.watcher.stop()
         except Exception:
             log.info('Failed to stop watcher', exc_info=True)
+        self.changes.close()
 
         self.executor.shutdown()
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+        self.workers.close()
+        if self.jobserver is not None:
+            self.jobserver.close()
+        self.save()
+        if self.trace:
+            self.tracer.write(self.trace)
+
+
+def same_task(a, b):
+    """
+    Return True if tasks ``a`` and ``b`` would build the same thing
+    """
+    return (
+        type(a) is type(b) and
+        a.output_file == b.output_file and
+        list(a.dependent) == list(b.dependent) and
+        sorted(a.get_flags()) == sorted(b.get_flags())
+    )
 
 
 def make(*tasks, **kwargs):
@@ -142,7 +486,19 @@ def make(*tasks, **kwargs):
         return maker
 
 
-def watch(func, reload_patterns=None, restart_patterns=None, **kwargs):
+def plan(*tasks, **kwargs):
+    """
+    Return the ``(task, reason)`` of every task ``make`` would run, without running anything.
+    Takes the same arguments as ``make``.
+    """
+    maker = Maker(*tasks, **kwargs)
+    try:
+        return maker.plan()
+    finally:
+        maker.close()
+
+
+def watch(func, reload_patterns=None, restart_patterns=None, include=None, exclude=None, **kwargs):
     """
     Compile and watch for changes.
 
@@ -152,6 +508,8 @@ def watch(func, reload_patterns=None, restart_patterns=None, **kwargs):
      the default is to rebuild for any observed change.
     :param restart_patterns:list of patterns to exit on. This is useful to restart
      the entire build if the build file itself is changed.
+    :param include:list of patterns. If given, only changes to matching files are watched.
+    :param exclude:list of patterns to ignore changes for, like ``node_modules/*``.
     :param kwargs: other options for Maker
     :return:Maker
     """
@@ -159,13 +517,8 @@ def watch(func, reload_patterns=None, restart_patterns=None, **kwargs):
 
     maker = None
     try:
-        while True:
-            maker = Maker(*func(), **kwargs)
-            ret = maker.watch(reload_patterns, restart_patterns)
-
-            if ret == Maker.STOP_WATCHING:
-                break
-
+        maker = Maker(*func(), **kwargs)
+        maker.watch(reload_patterns, restart_patterns, include, exclude, reload=func)
         return maker
     except KeyboardInterrupt:
         return maker
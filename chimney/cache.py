@@ -0,0 +1,200 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+from chimney.compilers import mkdirs, replace, temporary
+from chimney.db import digest
+
+
+log = logging.getLogger(__name__)
+
+
+class DirectoryBackend(object):
+    """
+    Stores cache entries as files in a directory, which can be shared between machines over NFS.
+
+    Other backends implement the same four methods. ``read()`` and ``write()`` keep small
+    records, ``fetch()`` and ``store()`` copy files in and out of the cache.
+
+    ``link`` - restore outputs as hard links to the cached files instead of copies. Only safe
+        if compilers replace their output files instead of writing to them in place.
+    """
+
+    def __init__(self, root, link=False):
+        self.root = root
+        self.link = link
+        super(DirectoryBackend, self).__init__()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def read(self, key):
+        """
+        Return the record stored for ``key`` or None
+        """
+        try:
+            with open(self.path(key) + '.json', 'rb') as f:
+                return f.read()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def write(self, key, data):
+        self._write(self.path(key) + '.json', lambda f: f.write(data))
+
+    def fetch(self, key, filename):
+        """
+        Replace ``filename`` with the file stored for ``key``. Returns False if there is none.
+        """
+        source = self.path(key)
+        if not os.path.isfile(source):
+            return False
+        mkdirs(os.path.dirname(filename) or os.curdir)
+        fd, tmp = temporary(filename)
+        os.close(fd)
+        try:
+            if self.link:
+                os.remove(tmp)
+                try:
+                    os.link(source, tmp)
+                except OSError:
+                    # another filesystem
+                    shutil.copyfile(source, tmp)
+            else:
+                shutil.copyfile(source, tmp)
+            replace(tmp, filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return True
+
+    def store(self, key, filename):
+        target = self.path(key)
+        if os.path.isfile(target):
+            # the same contents are stored already
+            return
+        with open(filename, 'rb') as source:
+            self._write(target, lambda f: shutil.copyfileobj(source, f))
+
+    def _write(self, target, write):
+        # a temporary file and a rename, so other machines never see half an entry
+        mkdirs(os.path.dirname(target))
+        # the permissions of any new file, not the 0600 of mkstemp, so others can read the entry
+        fd, tmp = temporary(target)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            replace(tmp, target)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+class ArtifactCache(object):
+    """
+    A content addressed cache of task outputs.
+
+    A task is looked up by its compiler, flags, output file and the contents of its declared
+    dependencies. The record found there has the digests of its ``outputs()``, which are stored
+    by their contents, and the digests of the inputs ``discover()`` found when it was built.
+    Those have to match as well for the outputs to be restored.
+
+    Paths are relative to the project directory, so checkouts in different places share entries.
+    Problems with the backend are logged and the task just runs.
+    """
+
+    def __init__(self, backend, directory=None):
+        if not hasattr(backend, 'fetch'):
+            backend = DirectoryBackend(backend)
+        self.backend = backend
+        self.directory = directory or os.path.abspath(os.curdir)
+        super(ArtifactCache, self).__init__()
+
+    def relative(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.directory).replace(os.sep, '/')
+
+    def key(self, task, inputs):
+        """
+        Return the key of ``task`` built from ``inputs``, the digests from ``BuildDatabase.check()``,
+        or None if an input is missing
+        """
+        digests = []
+        for source in task.dependent:
+            value = (inputs or {}).get(os.path.normpath(source)) or self.digest(source)
+            if value is None:
+                return None
+            digests.append((self.relative(source), value))
+        data = json.dumps([type(task).__name__, sorted(task.get_flags()), self.relative(task.output_file),
+                           sorted(digests)])
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def digests(self, task):
+        """
+        Return the digests of the declared dependencies of ``task`` like ``BuildDatabase.check()``
+        """
+        return dict((os.path.normpath(source), self.digest(source)) for source in task.dependent)
+
+    def digest(self, filename):
+        try:
+            return digest(filename)
+        except (IOError, OSError):
+            return None
+
+    def restore(self, task, inputs):
+        """
+        Restore the outputs of ``task`` if it has been built from the same inputs before.
+        Returns True if they were.
+        """
+        try:
+            key = self.key(task, inputs)
+            record = self.backend.read(key) if key is not None else None
+            if record is None:
+                return False
+            record = json.loads(record.decode('utf-8'))
+            for source, value in sorted(record['implicit'].items()):
+                if self.digest(os.path.join(self.directory, source)) != value:
+                    return False
+            outputs = record.get('outputs') or {}
+            for filename in task.outputs():
+                value = outputs.get(self.relative(filename))
+                if value is None or not self.backend.fetch(value, filename):
+                    return False
+        except (IOError, OSError, ValueError, KeyError):
+            log.warning(u'Failed to restore %s from the cache', task.output_file, exc_info=True)
+            return False
+        log.info(u'Restored %s from the cache', task.output_file)
+        return True
+
+    def save(self, task, inputs, implicit=()):
+        """
+        Store the outputs of a successful run of ``task`` along with the ``implicit`` inputs it discovered
+        """
+        try:
+            key = self.key(task, inputs)
+            if key is None:
+                return
+            if inputs is not None and self.key(task, None) != key:
+                # the output may have been built from either version
+                log.info(u'Not caching %s, an input changed while it was built', task.output_file)
+                return
+            outputs = {}
+            for filename in task.outputs():
+                value = self.digest(filename) if os.path.isfile(filename) else None
+                if value is None:
+                    # restoring only some of them would leave the others stale
+                    return
+                outputs[filename] = value
+            record = {
+                'outputs': dict((self.relative(f), value) for f, value in outputs.items()),
+                'implicit': dict((self.relative(f), self.digest(f)) for f in implicit),
+            }
+            for filename, value in sorted(outputs.items()):
+                self.backend.store(value, filename)
+            self.backend.write(key, json.dumps(record, sort_keys=True).encode('utf-8'))
+        except (IOError, OSError):
+            log.warning(u'Failed to store %s in the cache', task.output_file, exc_info=True)
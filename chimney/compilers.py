@@ -1,12 +1,21 @@
 from __future__ import print_function
+import binascii
+import collections
+import contextlib
+import errno
 import os
+import re
 import six
 import subprocess
 import logging
 import sys
+import threading
+import time
 from path import path
-from chimney import flags
+from chimney import discover, flags
 from chimney.flags import Arguments, Flag
+from chimney.index import DirectoryIndex, StatCache, has_magic
+from chimney.trace import NullTracer
 
 
 log = logging.getLogger(__name__)
@@ -20,6 +29,10 @@ class CompilerError(Exception):
         self.stderr = stderr
         super(CompilerError, self).__init__()
 
+    def __reduce__(self):
+        # so errors can be passed back from worker processes
+        return CompilerError, (self.command_args, self.returncode, self.stdout, self.stderr)
+
     def __repr__(self):
         ret = u'Returned exit code {0} for command: "{1}"'.format(
             self.returncode, self.command_args,
@@ -32,12 +45,86 @@ class CompilerError(Exception):
         return ret
 
 
+# how much of stderr to keep when a command's output is streamed to a file
+STDERR_LIMIT = 64 * 1024
+
+def replace(src, dst):
+    """
+    Rename ``src`` to ``dst``, replacing ``dst`` if it exists
+    """
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def temporary(filename):
+    """
+    Create a temporary file next to ``filename`` and return its descriptor and name. Unlike
+    ``mkstemp``, it gets the permissions of any new file, 0666 less the umask.
+    """
+    directory = os.path.dirname(filename) or os.curdir
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        tmp = os.path.join(directory, u'.{0}.{1}.tmp'.format(
+            os.path.basename(filename), binascii.hexlify(os.urandom(6)).decode('ascii')))
+        try:
+            return os.open(tmp, flags, 0o666), tmp
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def temporary_of(filename):
+    """
+    Return the file a temporary file from ``temporary()`` is next to, or None if it isn't one
+    """
+    directory, name = os.path.split(filename)
+    match = re.match(r'^\.(.+)\.[0-9a-f]{12}\.tmp$', name)
+    return os.path.join(directory, match.group(1)) if match else None
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode='wb'):
+    """
+    Open a temporary file next to ``filename`` for writing. It replaces ``filename`` when the
+    block finishes without an exception, so a failed build never leaves a partial output behind.
+    """
+    fd, tmp = temporary(filename)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        replace(tmp, filename)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def tail(stream, limit, chunks):
+    """
+    Read ``stream`` to the end, keeping about the last ``limit`` bytes in ``chunks``
+    """
+    size = 0
+    for chunk in iter(lambda: stream.read(8192), b''):
+        chunks.append(chunk)
+        size += len(chunk)
+        while size - len(chunks[0]) >= limit:
+            size -= len(chunks.popleft())
+    stream.close()
+
+
 def local(*args, **kw):
     """
     Run a local command
+
+    ``output`` - a file to stream stdout to instead of returning it. The file is only replaced
+        if the command succeeds.
     """
+    output = kw.pop('output', None)
     if log.isEnabledFor(logging.INFO):
-        log.info(' '.join(args[0]))
+        log.info(args[0] if isinstance(args[0], six.string_types) else ' '.join(args[0]))
     p = subprocess.Popen(
         *args,
         stdout=subprocess.PIPE,
@@ -46,10 +133,32 @@ def local(*args, **kw):
         **kw
     )
 
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
-        raise CompilerError(args, p.returncode, stdout, stderr)
-    return stdout, stderr
+    if output is None:
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise CompilerError(args, p.returncode, stdout, stderr)
+        return stdout, stderr
+
+    p.stdin.close()
+    # stderr has to be read at the same time or the command can block on a full pipe
+    errors = collections.deque()
+    reader = threading.Thread(target=tail, args=(p.stderr, STDERR_LIMIT, errors))
+    reader.daemon = True
+    reader.start()
+    try:
+        with atomic_write(output) as f:
+            for chunk in iter(lambda: p.stdout.read(65536), b''):
+                f.write(chunk)
+            p.wait()
+            reader.join()
+            if p.returncode != 0:
+                raise CompilerError(args, p.returncode, None, b''.join(errors))
+    finally:
+        p.stdout.close()
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+    return None, b''.join(errors)
 
 
 def mkdirs(path, mode=0777):
@@ -61,8 +170,37 @@ def mkdirs(path, mode=0777):
             raise
 
 
+class Command(object):
+    """
+    A command for a compiler to execute, with the keyword arguments of ``local()``
+    """
+
+    def __init__(self, args, **kw):
+        self.args = args
+        self.kw = kw
+
+    def __repr__(self):
+        return u'<Command {0}>'.format(self.args)
+
+
+def run_in_process(task):
+    """
+    Run a task in a worker process
+    """
+    task.run()
+
+
 class Compiler(object):
     arguments = Arguments()
+    # set to True to run() in a worker process instead of a thread. useful for CPU bound compilers
+    # written in Python, which would otherwise be serialized by the GIL
+    process = False
+    # the command line of a persistent worker to send commands to instead of starting a new
+    # process for every command. see chimney.workers
+    worker = None
+    # what a task uses while it runs, like {'cpu': 2, 'memory': 500} or {'node': 1}. tasks only
+    # start when these fit in the ``resources`` given to the Maker. a task needs one cpu by default
+    resources = {}
 
     def __init__(self, output_file, dependent, maker=None, extra_flags=None, **kwargs):
         """
@@ -74,6 +212,12 @@ class Compiler(object):
             If ``dependent`` is a string, it will be converted to a list.
         """
 
+        if isinstance(dependent, six.string_types) or callable(dependent):
+            dependent = [dependent]
+        # patterns and functions are expanded on first use, see ``dependent``
+        self.patterns = list(dependent)
+        self._dependent = None
+
         # the maker instance. this will be set when this instance is used by a Maker
         self.output_file = path(output_file)
         self.output_directory = None
@@ -81,9 +225,6 @@ class Compiler(object):
         self.maker = maker
         self.extra_flags = extra_flags or {}
 
-        if isinstance(dependent, six.string_types):
-            dependent = [dependent]
-        self.dependent = map(path, dependent)
         super(Compiler, self).__init__()
 
         # parse the keywords into extra_flags
@@ -101,10 +242,37 @@ class Compiler(object):
 
     @maker.setter
     def maker(self, v):
+        if v is not self._maker:
+            # expand the patterns again with the new maker's directory index
+            self._dependent = None
         self._maker = v
         if self._maker:
             self.output_directory = self.output_file.dirname()
 
+    @property
+    def dependent(self):
+        """
+        The list of dependent files, with glob patterns and functions expanded
+        """
+        if self._dependent is None:
+            self._dependent = self.expand(self.maker.index if self.maker is not None else DirectoryIndex())
+        return self._dependent
+
+    def expand(self, index):
+        """
+        Return the files matching ``patterns``, using ``index`` to list directories
+        """
+        expanded = []
+        for pattern in self.patterns:
+            if callable(pattern):
+                expanded.extend(pattern())
+            elif has_magic(pattern):
+                expanded.extend(index.glob(pattern))
+            else:
+                # literal names are kept even if they don't exist yet
+                expanded.append(pattern)
+        return map(path, collections.OrderedDict((f, True) for f in expanded))
+
     def sources(self):
         """
         A generator for dependent files for use with the compiler. The path to resources
@@ -119,35 +287,249 @@ class Compiler(object):
         """
         return [u'{0} {1}'.format(n, v) for n, v in six.iteritems(self.extra_flags)]
 
+    @property
+    def tracer(self):
+        return self.maker.tracer if self.maker is not None else NullTracer()
+
     def __call__(self, *args, **kwargs):
-        try:
-            if max([d.mtime for d in self.sources()]) < self.output_file.mtime:
-                return
-        except OSError as e:
-            # a file doesn't exist?
-            pass
+        with self.tracer.span(self.output_file, compiler=type(self).__name__):
+            return self.build()
+
+    def build(self):
+        """
+        Run the compiler if the output is out of date.
+
+        Returns False if the output didn't change, either because the compiler didn't run or
+        because it produced the same output as before.
+        """
+        stale, inputs = self.check()
+        if not stale:
+            return False
 
+        started = time.time()
+        if self.restore(inputs):
+            return self.built(inputs, started, restored=True)
         try:
-            self.run()
-        except CompilerError as c:
+            with self.tracer.span(u'run'):
+                if self.maker is not None and self.maker.in_process(self):
+                    self.maker.process_pool().submit(run_in_process, self).result()
+                else:
+                    self.run()
+        except Exception as e:
+            self.report(e)
+            # must reraise or anybody waiting for this will think it was successful
+            raise
+
+        return self.built(inputs, started)
+
+    def build_async(self, reactor, future):
+        """
+        Like ``build()``, but the commands from ``commands()`` run on ``reactor`` instead of
+        blocking a thread. The result or error is set on ``future``.
+
+        Only the commands are stepped through on the reactor thread. Checking, restoring and
+        recording the build are deferred to its helper threads, and so is setting the result,
+        so whatever that starts next doesn't run on the reactor thread or on top of this call.
+        """
+        tracer = self.tracer
+        begin = time.time()
+
+        def done(result=None, error=None):
+            tracer.complete(self.output_file, begin, compiler=type(self).__name__)
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+        def prepare():
+            try:
+                stale, inputs = self.check()
+                if not stale:
+                    return done(False)
+                started = time.time()
+                if self.restore(inputs):
+                    return done(self.built(inputs, started, restored=True))
+            except Exception as e:
+                return done(error=e)
+            reactor.call(lambda: run(inputs, started))
+
+        def finish(inputs, started):
+            try:
+                changed = self.built(inputs, started)
+            except Exception as e:
+                return done(error=e)
+            done(changed)
+
+        def run(inputs, started):
+            commands = self.commands()
+
+            def step(result=None, error=None):
+                try:
+                    command = commands.send(result) if error is None else commands.throw(error)
+                except StopIteration:
+                    tracer.complete(u'run', started)
+                    return reactor.defer(lambda: finish(inputs, started))
+                except Exception as e:
+                    tracer.complete(u'run', started)
+                    self.report(e)
+                    return reactor.defer(lambda: done(error=e))
+                reactor.submit(command, step)
+            step()
+
+        reactor.defer(prepare)
+
+    def asynchronous(self):
+        """
+        Return True if ``build_async()`` can be used, which is when ``run()`` only executes
+        the commands from ``commands()`` as local processes. Tasks with limited ``resources``
+        are left to the executor threads, which keep track of them.
+        """
+        maker = self.maker
+        return (
+            six.get_unbound_function(type(self).run) is six.get_unbound_function(Compiler.run) and
+            six.get_unbound_function(type(self).execute_command) is
+            six.get_unbound_function(Compiler.execute_command) and
+            not self.worker and
+            not (maker is not None and maker.in_process(self)) and
+            not (maker is not None and maker.resources and self.resources)
+        )
+
+    def check(self):
+        """
+        Return True if the output is out of date, and the input digests to record after the build
+        """
+        with self.tracer.span(u'check'):
+            reason, inputs = self.out_of_date(self.maker.stats if self.maker is not None else None)
+        if reason is None:
+            return False, inputs
+        log.debug(u'Building %s: %s', self.output_file, reason)
+        if inputs is None and self.maker is not None and self.maker.cache is not None:
+            # without a database, the cache needs the inputs as they were before the run
+            inputs = self.maker.cache.digests(self)
+        return True, inputs
+
+    def out_of_date(self, stats=None):
+        """
+        Return the reason the output is out of date, or None if it isn't, and the input digests
+        to record after the build. Nothing is run.
+
+        ``stats`` - a StatCache to take modification times from
+        """
+        database = self.maker.database if self.maker else None
+        if database is not None:
+            return database.check(self, stats)
+
+        stat = stats.stat if stats is not None else StatCache().stat
+        newest = None
+        for source in self.sources():
+            st = stat(source)
+            if st is None:
+                return u'missing input {0}'.format(source), None
+            if newest is None or st.st_mtime > newest[0]:
+                newest = (st.st_mtime, source)
+        output = stat(self.output_file)
+        if output is None:
+            return u'missing output', None
+        if newest is not None and newest[0] >= output.st_mtime:
+            return u'changed {0}'.format(newest[1]), None
+        return None, None
+
+    def report(self, e):
+        """
+        Report a failed run. Must be called while handling the exception.
+        """
+        if isinstance(e, CompilerError):
             log.error('Task failed')
             print(
                 u'========================================\n'
-                u'Task failed: {}'.format(repr(c)) +
+                u'Task failed: {}'.format(repr(e)) +
                 u'\n========================================',
                 file=sys.stderr
             )
-
-            # must reraise or anybody waiting for this will think it was successful
-            raise
-        except Exception:
+        else:
             log.exception('Task failed')
-            # must reraise or anybody waiting for this will think it was successful
-            raise
+
+    def restore(self, inputs):
+        """
+        Restore the output from the maker's artifact cache instead of running. Returns True if it was.
+        """
+        cache = self.maker.cache if self.maker is not None else None
+        if cache is None:
+            return False
+        with self.tracer.span(u'restore'):
+            return cache.restore(self, inputs)
+
+    def built(self, inputs, started, restored=False):
+        """
+        Record a successful run that started at ``started``, or that the output was ``restored``
+        from the artifact cache. Returns False if the output didn't change.
+        """
+        database = self.maker.database if self.maker else None
+        duration = time.time() - started
+        if self.maker is not None:
+            # tasks depending on the outputs must not see them as they were before
+            for output in self.outputs():
+                self.maker.stats.forget(output)
+        with self.tracer.span(u'discover'):
+            implicit = [os.path.normpath(f) for f in self.discover()]
+        if self.maker is not None:
+            self.maker.discovered(self, implicit)
+            if self.maker.cache is not None and not restored:
+                with self.tracer.span(u'store'):
+                    self.maker.cache.save(self, inputs, implicit)
+
+        if database is None:
+            return True
+        with self.tracer.span(u'record'):
+            return database.record(self, inputs, duration, implicit)
+
+    def discover(self):
+        """
+        Return the inputs the last ``run()`` read besides ``dependent``, like the files a
+        stylesheet imports. The task is rebuilt when those change, too. See chimney.discover
+        for parsing depfiles, source maps and imports.
+        """
+        return []
+
+    def outputs(self):
+        """
+        Return every file ``run()`` writes, ``output_file`` first. Compilers writing more than
+        their output file, like a source map next to it, add the others here.
+        """
+        return [self.output_file]
 
     def run(self):
+        """
+        Run the compiler. By default this executes the commands from ``commands()``.
+        """
+        commands = self.commands()
+        result = error = None
+        while True:
+            try:
+                command = commands.send(result) if error is None else commands.throw(*error)
+            except StopIteration:
+                return
+            try:
+                result, error = self.execute_command(command.args, **command.kw), None
+            except Exception:
+                result, error = None, sys.exc_info()
+
+    def commands(self):
+        """
+        A generator of the Commands to execute, one after the other. The stdout and stderr of
+        each command are sent back to the generator.
+        """
         raise NotImplementedError()
 
+    def __getstate__(self):
+        # the maker stays behind when this is sent to a worker process
+        state = self.__dict__.copy()
+        state['_maker'] = None
+        # functions might not be picklable
+        state['_dependent'] = self.dependent
+        state['patterns'] = list(self.dependent)
+        return state
+
     def __repr__(self):
         return u'<{} -> [{}]>'.format(self.output_file, ', '.join(self.dependent))
 
@@ -155,45 +537,49 @@ class Compiler(object):
         """
         Execute a command
         """
-        return local(*args, **kw)
+        tracer = self.tracer
+        if not (self.worker and self.maker is not None):
+            if self.maker is not None and self.maker.jobserver is not None and 'env' not in kw:
+                # so nested makes and other tools share the jobs
+                kw['env'] = self.maker.jobserver.environ()
+            with tracer.span(u'execute', cat='subprocess'):
+                return local(*args, **kw)
+
+        with tracer.span(u'execute', cat='worker'):
+            stdout, stderr = self.maker.workers.execute(self.worker, args[0])
+        output = kw.get('output')
+        if output is None:
+            return stdout, stderr
+        with tracer.span(u'write'):
+            with atomic_write(output) as f:
+                f.write(stdout)
+        return None, stderr
 
 
 class ShellCompilerMixin(object):
     def execute_command(self, *args, **kw):
-        # uglify run without shell=True doesn't create source maps, todo
-        if log.isEnabledFor(logging.INFO):
-            log.info(' '.join(args[0]))
-        p = subprocess.Popen(
-            ' '.join(args[0]),
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True,
-            **kw
-        )
-
-        stdout, stderr = p.communicate()
-        returncode = p.poll()
-        if returncode != 0:
-            raise CompilerError(args, returncode, stdout, stderr)
-        return stdout, stderr
+        if not self.worker:
+            # uglify run without shell=True doesn't create source maps, todo
+            args = (' '.join(args[0]),) + args[1:]
+            kw['shell'] = True
+        return super(ShellCompilerMixin, self).execute_command(*args, **kw)
 
 
 class coffee(Compiler):
-    def run(self):
+    def commands(self):
         mkdirs(self.output_directory)
 
         # stupid coffee compiler expects a directory and you can't just give it an output file _name_
-        stdout, stderr = self.execute_command(['coffee', '--print'] + list(self.sources()))
         log.info('writing {0}'.format(self.output_file))
-        with open(self.output_file, 'wb') as f:
-            f.write(stdout)
+        yield Command(['coffee', '--print'] + list(self.sources()), output=self.output_file)
 
 
 class sqwish(Compiler):
-    def run(self):
-        cmd = ['sqwish'] + list(self.sources()) + ['-o', self.output_file]
-        self.execute_command(cmd)
+    def commands(self):
+        yield Command(['sqwish'] + list(self.sources()) + ['-o', self.output_file])
+
+    def discover(self):
+        return discover.imports(list(self.sources()))
 
 
 class uglify(ShellCompilerMixin, Compiler):
@@ -221,17 +607,26 @@ class uglify(ShellCompilerMixin, Compiler):
 
         super(uglify, self).__init__(output_file, dependent, maker, extra_flags, **kwargs)
 
-    def run(self):
+    def outputs(self):
+        source_map = self.extra_flags.get(u'--source-map')
+        return [self.output_file] + ([path(source_map)] if source_map else [])
+
+    def commands(self):
         mkdirs(self.output_directory)
 
-        cmd = ['uglifyjs'] + self.get_flags() + ['-o', self.output_file] + list(self.sources())
-        self.execute_command(cmd)
+        yield Command(['uglifyjs'] + self.get_flags() + ['-o', self.output_file] + list(self.sources()))
 
 
 class compass(Compiler):
     """
     The Compass compiler for sass projects
     """
-    def run(self):
+    # ruby and libsass take a few hundred megabytes
+    resources = {'memory': 300}
+
+    def commands(self):
         # this assumes you have most project settings defined in config.rb
-        self.execute_command(['compass', 'compile'] + list(self.sources()))
+        yield Command(['compass', 'compile'] + list(self.sources()))
+
+    def discover(self):
+        return discover.imports([s for s in self.sources() if os.path.isfile(s)])
@@ -0,0 +1,206 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import six
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+def digest(filename, blocksize=65536):
+    """
+    Return the sha1 hex digest of a file's contents
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BuildDatabase(object):
+    """
+    An on-disk record of what every task was last built from.
+
+    For each task the database stores the digest of every input, the flags from ``get_flags()``
+    and the digest of the output. A task only needs to run when one of those has changed, so
+    a checkout or a ``touch`` that leaves the contents alone doesn't cause a rebuild. Inputs
+    found by ``Compiler.discover()`` are stored as well and count like the declared ones.
+
+    File digests are cached along with the mtime and size they were computed for, so unchanged
+    files are never read twice.
+    """
+    VERSION = 1
+
+    def __init__(self, filename, readonly=False):
+        self.filename = filename
+        # if True, nothing is remembered or saved
+        self.readonly = readonly
+        # path -> [mtime, size, digest]
+        self.files = {}
+        # output file -> record of the last successful build
+        self.tasks = {}
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            # missing or unreadable, everything will be rebuilt
+            return
+
+        if data.get('version') != self.VERSION:
+            log.info('Ignoring build database with version %s', data.get('version'))
+            return
+
+        self.files = data.get('files') or {}
+        self.tasks = data.get('tasks') or {}
+
+    def save(self):
+        """
+        Write the database to disk if anything changed
+        """
+        with self.lock:
+            if not self.dirty or self.readonly:
+                return
+            data = json.dumps({
+                'version': self.VERSION,
+                'files': self.files,
+                'tasks': self.tasks,
+            })
+            self.dirty = False
+
+        directory = os.path.dirname(self.filename)
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # write to a temporary file and rename it so a crash can't leave half a database
+        tmp = u'{0}.{1}.tmp'.format(self.filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data.encode('utf-8'))
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp, self.filename)
+
+    def digest(self, filename, stats=None):
+        """
+        Return the content digest of ``filename`` or None if it doesn't exist
+
+        ``stats`` - a StatCache to take the file's mtime and size from
+        """
+        key = os.path.normpath(filename)
+        if stats is not None:
+            st = stats.stat(key)
+            if st is None:
+                return None
+        else:
+            try:
+                st = os.stat(key)
+            except OSError:
+                return None
+
+        cached = self.files.get(key)
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return cached[2]
+
+        value = digest(key)
+        if self.readonly:
+            return value
+        with self.lock:
+            self.files[key] = [st.st_mtime, st.st_size, value]
+            self.dirty = True
+        return value
+
+    def check(self, task, stats=None):
+        """
+        Decide if ``task`` needs to run.
+
+        Returns a tuple of the reason to run (or None when up to date) and the input digests,
+        which should be passed back to ``record()`` after a successful run.
+
+        ``stats`` - a StatCache shared by the tasks being checked
+        """
+        inputs = {}
+        reason = None
+        record = self.tasks.get(os.path.normpath(task.output_file))
+        for source in list(task.dependent) + self.implicit(task):
+            key = os.path.normpath(source)
+            inputs[key] = self.digest(key, stats)
+            if inputs[key] is None and reason is None:
+                reason = u'missing input {0}'.format(source)
+
+        if reason:
+            return reason, inputs
+
+        if record is None:
+            return u'no previous build', inputs
+        if record['compiler'] != type(task).__name__ or record['flags'] != sorted(task.get_flags()):
+            return u'command changed', inputs
+        if record['inputs'] != inputs:
+            changed = sorted(k for k in set(inputs) | set(record['inputs'])
+                             if inputs.get(k) != record['inputs'].get(k))
+            return u'changed {0}'.format(', '.join(changed)), inputs
+
+        output = self.digest(task.output_file, stats)
+        if output is None:
+            return u'missing output', inputs
+        if output != record['output']:
+            return u'output modified', inputs
+
+        return None, inputs
+
+    def record(self, task, inputs, duration=None, implicit=None):
+        """
+        Remember a successful build of ``task`` from ``inputs`` that took ``duration`` seconds.
+        ``implicit`` are the inputs it discovered, which are checked along with ``inputs`` from now on.
+
+        Returns False if the output is identical to the one from the previous build, so tasks
+        depending on it don't have to run.
+        """
+        key = os.path.normpath(task.output_file)
+        output = self.digest(task.output_file)
+        implicit = sorted(set(os.path.normpath(f) for f in implicit or ()))
+        # inputs that were discovered last time but not this time are dropped
+        sources = set(os.path.normpath(f) for f in task.dependent) | set(implicit)
+        inputs = dict((k, v) for k, v in six.iteritems(inputs) if k in sources)
+        for source in implicit:
+            if source not in inputs:
+                inputs[source] = self.digest(source)
+        with self.lock:
+            previous = self.tasks.get(key)
+            self.tasks[key] = {
+                'compiler': type(task).__name__,
+                'flags': sorted(task.get_flags()),
+                'inputs': inputs,
+                'output': output,
+                'duration': duration,
+                'implicit': implicit,
+            }
+            self.dirty = True
+        # a task that doesn't write its output file might have changed anything
+        return output is None or previous is None or previous['output'] != output
+
+    def implicit(self, task):
+        """
+        Return the inputs ``task`` discovered the last time it was built
+        """
+        record = self.tasks.get(os.path.normpath(task.output_file))
+        return list(record.get('implicit') or ()) if record else []
+
+    def durations(self):
+        """
+        Return the last recorded run time of every task by output file
+        """
+        with self.lock:
+            return dict((output_file, record['duration']) for output_file, record in six.iteritems(self.tasks)
+                        if record.get('duration') is not None)
@@ -0,0 +1,90 @@
+import io
+import json
+import os
+import re
+
+
+def depfile(filename):
+    """
+    Return the prerequisites listed in a make style dependency file, like ``gcc -MD`` writes
+    """
+    try:
+        with io.open(filename, encoding='utf-8') as f:
+            text = f.read()
+    except (IOError, OSError):
+        return []
+
+    files = []
+    # a rule can be continued on the next line with a backslash
+    for rule in re.split(r'(?<!\\)\n', text):
+        if ':' not in rule:
+            continue
+        prerequisites = rule.split(':', 1)[1].replace('\\\n', ' ')
+        # spaces in names are escaped with a backslash
+        for name in re.split(r'(?<!\\)\s+', prerequisites.strip()):
+            if name:
+                files.append(name.replace('\\ ', ' '))
+    return files
+
+
+def source_map(filename):
+    """
+    Return the ``sources`` of a source map, relative to the current directory
+    """
+    try:
+        with io.open(filename, encoding='utf-8') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+
+    root = os.path.join(os.path.dirname(filename), data.get('sourceRoot') or '')
+    return [os.path.normpath(os.path.join(root, source)) for source in data.get('sources') or []
+            if '://' not in source]
+
+
+import_statement = re.compile(r'@import\s+([^;\n]+)')
+import_name = re.compile(r'''url\(\s*['"]?([^'")]+)['"]?\s*\)|['"]([^'"]+)['"]''')
+
+
+def resolve_import(directory, name):
+    """
+    Return the file a Sass or CSS ``@import`` of ``name`` refers to, or None if there isn't one
+    """
+    if '://' in name or name.startswith('//'):
+        return None
+    head, tail = os.path.split(os.path.join(directory, name))
+    candidates = [os.path.join(head, tail)]
+    if not os.path.splitext(tail)[1]:
+        # sass looks for partials with a leading underscore and any extension
+        candidates = [os.path.join(head, prefix + tail + ext)
+                      for prefix in ('', '_') for ext in ('.scss', '.sass', '.css')]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return os.path.normpath(candidate)
+    return None
+
+
+def imports(filenames):
+    """
+    Follow the ``@import`` statements of stylesheets and return every file they import,
+    directly or not
+    """
+    found = []
+    seen = set(os.path.normpath(f) for f in filenames)
+    stack = list(filenames)
+    while stack:
+        filename = stack.pop()
+        try:
+            with io.open(filename, encoding='utf-8', errors='replace') as f:
+                text = f.read()
+        except (IOError, OSError):
+            continue
+
+        for statement in import_statement.findall(text):
+            for url, quoted in import_name.findall(statement):
+                imported = resolve_import(os.path.dirname(filename), url or quoted)
+                if imported is not None and imported not in seen:
+                    seen.add(imported)
+                    found.append(imported)
+                    stack.append(imported)
+    return found
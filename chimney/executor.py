@@ -1,4 +1,9 @@
+import heapq
+import itertools
+import six
 import threading
+import time
+from chimney.trace import NullTracer
 from concurrent.futures import _base
 from concurrent.futures.thread import _WorkItem, _worker, _threads_queues
 import weakref
@@ -9,21 +14,116 @@ except ImportError:
     import Queue as queue
 
 
+class Budget(object):
+    """
+    Limits on named resources, like ``{'cpu': 4, 'memory': 2048}``, shared by running tasks.
+    Resources without a limit are unlimited.
+    """
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.used = dict.fromkeys(self.limits, 0)
+
+    def fits(self, weights):
+        """
+        Return True if a task using ``weights`` can start now
+        """
+        for name, amount in six.iteritems(weights):
+            limit = self.limits.get(name)
+            # a task needing more than everything still runs, on its own
+            if limit is not None and self.used[name] and self.used[name] + amount > limit:
+                return False
+        return True
+
+    def take(self, weights):
+        for name, amount in six.iteritems(weights):
+            if name in self.used:
+                self.used[name] += amount
+
+    def release(self, weights):
+        for name, amount in six.iteritems(weights):
+            if name in self.used:
+                self.used[name] -= amount
+
+
+class WorkQueue(queue.Queue):
+    """
+    A queue handing out the work item with the highest ``priority`` first, in the order they were
+    put among equals. ``None``, which tells workers to exit, comes after everything else.
+
+    With a ``budget``, only items whose ``resources`` fit are handed out. A higher priority item
+    that doesn't fit is passed over for lighter ones until enough resources are released.
+    """
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.counter = itertools.count()
+        self.budget = None
+
+    def _qsize(self, len=len):
+        if self.budget is None or not self.queue or self.fits(self.queue[0]):
+            return len(self.queue)
+        return sum(1 for entry in self.queue if self.fits(entry))
+
+    def fits(self, entry):
+        item = entry[2]
+        return item is None or self.budget.fits(item.resources)
+
+    def _put(self, item):
+        priority = float('inf') if item is None else -item.priority
+        heapq.heappush(self.queue, (priority, next(self.counter), item))
+
+    def _get(self):
+        if self.budget is None:
+            return heapq.heappop(self.queue)[2]
+
+        if self.fits(self.queue[0]):
+            entry = heapq.heappop(self.queue)
+        else:
+            entry = min(e for e in self.queue if self.fits(e))
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+        item = entry[2]
+        if item is not None:
+            self.budget.take(item.resources)
+            item.taken = True
+        return item
+
+    def release(self, item):
+        """
+        Give back the resources of a finished item
+        """
+        with self.not_empty:
+            if getattr(item, 'taken', False):
+                item.taken = False
+                self.budget.release(item.resources)
+                self.not_empty.notify_all()
+
+
 class DelayedThreadPoolExecutor(_base.Executor):
-    def __init__(self, max_workers):
+    def __init__(self, max_workers, resources=None):
         """Initializes a new ThreadPoolExecutor instance.
 
         Args:
             max_workers: The maximum number of threads that can be used to
                 execute the given calls.
+            resources: Limits of resources tasks declare in ``resources``. Tasks
+                need one ``cpu`` by default and there are ``max_workers`` of those.
         """
         self._max_workers = max_workers
-        self._work_queue = queue.Queue()
+        self._work_queue = WorkQueue()
+        if resources:
+            limits = {'cpu': max_workers}
+            limits.update(resources)
+            self._work_queue.budget = Budget(limits)
         self._threads = set()
         self._shutdown = False
         self._shutdown_lock = threading.Lock()
 
         self._start_queue = []
+        self.tracer = NullTracer()
+        # a JobServer to take a token from before running a task
+        self.jobserver = None
 
     def queue(self, runner):
         self._start_queue.append(runner)
@@ -37,9 +137,32 @@ class DelayedThreadPoolExecutor(_base.Executor):
             if self._shutdown:
                 raise RuntimeError('cannot schedule new futures after shutdown')
 
-            w = _WorkItem(runner.future, runner.task, args, kw)
+            tracer = self.tracer
+            jobserver = self.jobserver
+            name = getattr(runner.task, 'output_file', None) or repr(runner.task)
+            submitted = time.time()
+            if getattr(runner, 'waiting_for', None) and runner.scheduled is not None:
+                tracer.interval(name, runner.scheduled, submitted, cat='dependencies')
+
+            def run():
+                if jobserver is None:
+                    tracer.interval(name, submitted, cat='queue')
+                    return runner.task(*args, **kw)
+
+                token = jobserver.acquire()
+                tracer.interval(name, submitted, cat='queue')
+                try:
+                    return runner.task(*args, **kw)
+                finally:
+                    jobserver.release(token)
+
+            w = _WorkItem(runner.future, run, (), {})
+            w.priority = getattr(runner, 'priority', 0)
+            w.resources = dict({'cpu': 1}, **(getattr(runner.task, 'resources', None) or {}))
 
             def on_done(f):
+                if self._work_queue.budget is not None:
+                    self._work_queue.release(w)
                 self._work_queue.task_done()
             runner.future.add_done_callback(on_done)
             self._work_queue.put(w)
@@ -74,6 +197,13 @@ class DelayedThreadPoolExecutor(_base.Executor):
                 t.join()
     shutdown.__doc__ = _base.Executor.shutdown.__doc__
 
+    def busy(self):
+        """
+        Return True if tasks are queued or running
+        """
+        with self._work_queue.all_tasks_done:
+            return bool(self._work_queue.unfinished_tasks)
+
     def wait(self):
         self._work_queue.all_tasks_done.acquire()
         try:
@@ -0,0 +1,219 @@
+import fnmatch
+import os
+import re
+import six
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+magic = re.compile(r'[*?[]')
+
+
+def has_magic(pattern):
+    return magic.search(pattern) is not None
+
+
+class DirectoryIndex(object):
+    """
+    A cache of directory listings for expanding glob patterns.
+
+    Every directory is read at most once, however many patterns look at it. In watch mode the
+    listings are kept current with ``update()`` instead of being read again.
+    """
+
+    def __init__(self):
+        # absolute directory -> (set of subdirectory names, set of file names)
+        self.directories = {}
+        self.lock = threading.RLock()
+
+    def listdir(self, directory):
+        """
+        Return the names of subdirectories and files in ``directory``
+        """
+        key = os.path.abspath(directory)
+        with self.lock:
+            listing = self.directories.get(key)
+            if listing is None:
+                listing = self.directories[key] = self.read(key)
+            return listing
+
+    def read(self, directory):
+        dirs, files = set(), set()
+        try:
+            if scandir is not None:
+                for entry in scandir(directory):
+                    (dirs if entry.is_dir() else files).add(entry.name)
+            else:
+                for name in os.listdir(directory):
+                    (dirs if os.path.isdir(os.path.join(directory, name)) else files).add(name)
+        except OSError:
+            # missing or unreadable directories have nothing in them
+            pass
+        return dirs, files
+
+    def glob(self, pattern):
+        """
+        Return the sorted list of paths matching ``pattern``. Besides the usual shell patterns,
+        ``**`` matches any number of directories.
+        """
+        pattern = pattern.replace(os.sep, '/')
+        parts = [p for p in pattern.split('/') if p]
+        base = '/' if pattern.startswith('/') else ''
+        # directories before the first wildcard don't have to be listed
+        while len(parts) > 1 and not has_magic(parts[0]):
+            base = os.path.join(base, parts.pop(0))
+        found = set()
+        self._glob(base, parts, found)
+        return sorted(found)
+
+    def _glob(self, base, parts, found):
+        if not parts:
+            found.add(base)
+            return
+
+        part, rest = parts[0], parts[1:]
+        dirs, files = self.listdir(base or os.curdir)
+        if part == '**':
+            self._glob(base, rest, found)
+            for name in dirs:
+                if not name.startswith('.'):
+                    self._glob(os.path.join(base, name), parts, found)
+        elif has_magic(part):
+            names = dirs if rest else dirs | files
+            for name in fnmatch.filter(names, part):
+                # like the shell, wildcards don't match hidden files
+                if part.startswith('.') or not name.startswith('.'):
+                    self._glob(os.path.join(base, name), rest, found)
+        elif part in dirs or (not rest and part in files) or part in ('.', '..'):
+            self._glob(os.path.join(base, part), rest, found)
+
+    def lists(self, filename):
+        """
+        Return True if ``filename`` is in a listing that has been read already
+        """
+        parent, name = os.path.split(os.path.abspath(filename))
+        with self.lock:
+            listing = self.directories.get(parent)
+            return listing is not None and (name in listing[0] or name in listing[1])
+
+    def update(self, filename, event_type):
+        """
+        Update the listings for a file or directory that was created, deleted or moved
+        """
+        key = os.path.abspath(filename)
+        parent, name = os.path.split(key)
+        with self.lock:
+            if event_type == 'moved':
+                # the destination isn't known, so read the directory again next time
+                self.directories.pop(parent, None)
+                self.forget(key)
+                return
+
+            listing = self.directories.get(parent)
+            if event_type == 'created':
+                if listing is not None:
+                    listing[0 if os.path.isdir(key) else 1].add(name)
+            elif event_type == 'deleted':
+                if listing is not None:
+                    listing[0].discard(name)
+                    listing[1].discard(name)
+                self.forget(key)
+
+    def forget(self, directory):
+        """
+        Drop the listings of ``directory`` and everything below it
+        """
+        prefix = directory + os.sep
+        with self.lock:
+            for key in [k for k in self.directories if k == directory or k.startswith(prefix)]:
+                del self.directories[key]
+
+
+class StatCache(object):
+    """
+    The ``os.stat()`` of files by absolute path, taken at most once per path.
+
+    Many tasks share dependencies, so checking them one task at a time would stat the same
+    files over and over. Files that change have to be forgotten with ``forget()``.
+    """
+
+    def __init__(self):
+        # absolute path -> stat result or None if the file doesn't exist
+        self.stats = {}
+        # counts forget() and clear(), so a stat taken before one of them isn't kept
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def stat(self, filename):
+        """
+        Return the stat result of ``filename`` or None if it doesn't exist
+        """
+        key = os.path.abspath(filename)
+        with self.lock:
+            if key in self.stats:
+                return self.stats[key]
+            generation = self.generation
+        try:
+            st = os.stat(key)
+        except OSError:
+            st = None
+        with self.lock:
+            if generation != self.generation:
+                # the file may have changed after it was stat'ed
+                return st
+            return self.stats.setdefault(key, st)
+
+    def prefetch(self, filenames):
+        """
+        Stat all of ``filenames`` that haven't been, one directory after the other
+        """
+        with self.lock:
+            keys = set(os.path.abspath(f) for f in filenames) - set(self.stats)
+        directories = {}
+        for key in keys:
+            directories.setdefault(os.path.dirname(key), []).append(key)
+
+        for directory, files in sorted(six.iteritems(directories)):
+            if scandir is not None and os.name == 'nt' and len(files) > 1:
+                # listing a directory returns the stat of every file in it for free on Windows.
+                # elsewhere it costs a stat per entry, more than the files asked for
+                self.scan(directory, files)
+            for key in files:
+                self.stat(key)
+
+    def scan(self, directory, files):
+        wanted = set(files)
+        found = {}
+        with self.lock:
+            generation = self.generation
+        try:
+            for entry in scandir(directory):
+                if entry.path in wanted:
+                    found[entry.path] = entry.stat()
+        except OSError:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            for key in files:
+                self.stats.setdefault(key, found.get(key))
+
+    def forget(self, filename):
+        """
+        Stat ``filename`` again the next time, because it changed
+        """
+        with self.lock:
+            self.stats.pop(os.path.abspath(filename), None)
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.stats.clear()
+            self.generation += 1
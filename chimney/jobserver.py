@@ -0,0 +1,132 @@
+import errno
+import logging
+import os
+import re
+import select
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class JobServer(object):
+    """
+    A GNU make jobserver: a pipe holding one byte for every job that may run besides the one
+    every process gets for free. Tasks take a token before they run and put it back afterwards,
+    and child processes like a nested ``make`` find the pipe in ``MAKEFLAGS`` and do the same,
+    so the whole process tree runs at most ``jobs`` jobs.
+    """
+
+    def __init__(self, read_fd, write_fd, makeflags, owned=False):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        # MAKEFLAGS for child processes
+        self.makeflags = makeflags
+        # True if the pipe was created by this process and should be closed with it
+        self.owned = owned
+        self.lock = threading.Lock()
+        # the free token is in use
+        self.implicit = False
+        super(JobServer, self).__init__()
+
+    @classmethod
+    def create(cls, jobs):
+        """
+        Start a jobserver for ``jobs`` jobs
+        """
+        read_fd, write_fd = os.pipe()
+        for fd in (read_fd, write_fd):
+            if hasattr(os, 'set_inheritable'):
+                os.set_inheritable(fd, True)
+        os.write(write_fd, b'+' * (jobs - 1))
+        flags = strip_jobserver(os.environ.get('MAKEFLAGS', ''))
+        auth = u'{0},{1}'.format(read_fd, write_fd)
+        # --jobserver-fds for make before 4.2
+        makeflags = u' '.join(f for f in [flags, u'-j{0}'.format(jobs),
+                                          u'--jobserver-fds=' + auth, u'--jobserver-auth=' + auth] if f)
+        return cls(read_fd, write_fd, makeflags, owned=True)
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        """
+        Join the jobserver of a parent make from ``MAKEFLAGS``, or return None if there isn't one
+        """
+        makeflags = (os.environ if environ is None else environ).get('MAKEFLAGS', '')
+        # the last one wins, like in make
+        found = re.findall(r'--jobserver-(?:auth|fds)=(\S+)', makeflags)
+        if not found:
+            return None
+
+        auth = found[-1]
+        try:
+            if auth.startswith('fifo:'):
+                read_fd = write_fd = os.open(auth[len('fifo:'):], os.O_RDWR)
+            else:
+                read_fd, write_fd = [int(fd) for fd in auth.split(',')]
+                os.fstat(read_fd)
+                os.fstat(write_fd)
+        except (OSError, ValueError):
+            # make only passes the pipe to commands it knows are makes, like ones starting with +
+            log.warning('Ignoring the jobserver in MAKEFLAGS, it is not available: %s', auth)
+            return None
+        return cls(read_fd, write_fd, makeflags)
+
+    def acquire(self):
+        """
+        Block until a job may run and return its token
+        """
+        with self.lock:
+            if not self.implicit:
+                self.implicit = True
+                return None
+        while True:
+            try:
+                token = os.read(self.read_fd, 1)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    # somebody made the pipe non-blocking
+                    select.select([self.read_fd], [], [])
+                    continue
+                raise
+            if not token:
+                raise IOError(errno.EPIPE, 'The jobserver was closed')
+            return token
+
+    def release(self, token):
+        """
+        Return a token from ``acquire()``
+        """
+        if token is None:
+            with self.lock:
+                self.implicit = False
+            return
+        while True:
+            try:
+                os.write(self.write_fd, token)
+                return
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+    def environ(self, environ=None):
+        """
+        Return a copy of ``environ`` (defaults to ``os.environ``) that tells children about the jobserver
+        """
+        environ = dict(os.environ if environ is None else environ)
+        environ['MAKEFLAGS'] = self.makeflags
+        return environ
+
+    def close(self):
+        if self.owned:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+
+
+def strip_jobserver(makeflags):
+    """
+    Remove the jobserver and job count from ``makeflags``
+    """
+    words = [w for w in makeflags.split() if not re.match(r'(--jobserver-(auth|fds)=|-j\d*$)', w)]
+    return u' '.join(words)
@@ -0,0 +1,374 @@
+import collections
+import logging
+import os
+import select
+import six
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from chimney.compilers import CompilerError, STDERR_LIMIT, atomic_write
+
+
+log = logging.getLogger(__name__)
+
+
+def readable(fds):
+    """
+    Block until some of ``fds`` can be read and return those
+    """
+    if hasattr(select, 'poll'):
+        # select() can't handle descriptors above FD_SETSIZE
+        poll = select.poll()
+        for fd in fds:
+            poll.register(fd, select.POLLIN)
+        return [fd for fd, event in poll.poll()]
+    return select.select(fds, [], [])[0]
+
+
+class Process(object):
+    """
+    A command started by the CommandReactor and what it has written so far
+    """
+
+    def __init__(self, command, callback):
+        self.command = command
+        self.callback = callback
+        self.popen = None
+        # the atomic_write of the output file and the file itself if stdout goes there
+        self.writer = None
+        self.file = None
+        self.stdout = []
+        self.stderr = collections.deque()
+        self.stderr_size = 0
+        # pipes that haven't reached end of file
+        self.open = 0
+        # the jobserver token taken for this command
+        self.token = None
+
+    def write(self, name, chunk):
+        if name == 'stdout':
+            if self.file is not None:
+                self.file.write(chunk)
+            else:
+                self.stdout.append(chunk)
+            return
+
+        self.stderr.append(chunk)
+        self.stderr_size += len(chunk)
+        # like local(), keep only the end of stderr when stdout goes to a file
+        while self.file is not None and self.stderr_size - len(self.stderr[0]) >= STDERR_LIMIT:
+            self.stderr_size -= len(self.stderr.popleft())
+
+
+class CommandReactor(object):
+    """
+    Runs commands as child processes and collects their output on a single thread, so a
+    running command doesn't need a thread of its own. At most ``jobs`` commands run at a
+    time, the rest wait for their turn.
+
+    With a ``jobserver``, every command also takes a token, which a helper thread waits for
+    so the reactor thread never blocks on the jobserver. Other work that would block the
+    reactor thread, like reading and hashing files, goes to helper threads with ``defer()``.
+    """
+
+    def __init__(self, jobs, jobserver=None):
+        self.jobs = jobs
+        self.jobserver = jobserver
+        self.lock = threading.Lock()
+        # (command, callback, token) waiting for a free slot
+        self.waiting = collections.deque()
+        # (command, callback) waiting for a jobserver token
+        self.tokenless = collections.deque()
+        self.tokens = threading.Condition(self.lock)
+        self.running = 0
+        # pipe -> (Process, 'stdout' or 'stderr')
+        self.pipes = {}
+        # functions to call on the reactor thread
+        self.calls = collections.deque()
+        self.helpers = ThreadPoolExecutor(jobs)
+        self.closed = False
+        self.wakeup_read, self.wakeup_write = os.pipe()
+
+        self.thread = threading.Thread(target=self.loop, name='CommandReactor')
+        self.thread.daemon = True
+        self.thread.start()
+        if jobserver is not None:
+            self.token_thread = threading.Thread(target=self.acquire_tokens, name='CommandReactor tokens')
+            self.token_thread.daemon = True
+            self.token_thread.start()
+        super(CommandReactor, self).__init__()
+
+    def submit(self, command, callback):
+        """
+        Run a Command. ``callback`` is called on the reactor thread with the stdout and stderr,
+        like ``local()`` returns them, or with the ``error`` keyword if the command failed.
+        """
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('cannot run commands after close')
+            if self.jobserver is not None:
+                self.tokenless.append((command, callback))
+                self.tokens.notify()
+                return
+            self.waiting.append((command, callback, None))
+        self.wake()
+
+    def call(self, function):
+        """
+        Call ``function`` on the reactor thread once it is done with what it is doing now
+        """
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('cannot run commands after close')
+            self.calls.append(function)
+        self.wake()
+
+    def defer(self, function):
+        """
+        Call ``function`` on a helper thread, for work that would block the reactor thread
+        """
+        def deferred():
+            try:
+                function()
+            except Exception:
+                log.exception('Error in deferred call')
+        self.helpers.submit(deferred)
+
+    def wake(self):
+        if threading.current_thread() is not self.thread:
+            # the reactor thread starts waiting commands before it blocks again
+            os.write(self.wakeup_write, b'x')
+
+    def acquire_tokens(self):
+        """
+        Hand commands to the reactor thread as jobserver tokens become available
+        """
+        while True:
+            with self.lock:
+                while not self.tokenless and not self.closed:
+                    self.tokens.wait()
+                if self.closed:
+                    return
+                command, callback = self.tokenless.popleft()
+            try:
+                token = self.jobserver.acquire()
+            except (IOError, OSError):
+                log.warning('Lost the jobserver', exc_info=True)
+                return
+            with self.lock:
+                if self.closed:
+                    self.jobserver.release(token)
+                    return
+                self.waiting.append((command, callback, token))
+            self.wake()
+
+    def loop(self):
+        while True:
+            with self.lock:
+                calls, self.calls = self.calls, collections.deque()
+            for function in calls:
+                try:
+                    function()
+                except Exception:
+                    log.exception('Error in reactor call')
+
+            with self.lock:
+                if self.closed:
+                    break
+                starting = []
+                while self.waiting and self.running < self.jobs:
+                    starting.append(self.waiting.popleft())
+                    self.running += 1
+            for command, callback, token in starting:
+                self.start(command, callback, token)
+            if self.waiting and self.running < self.jobs:
+                # a command failed to start and left a slot
+                continue
+
+            for fd in readable(list(self.pipes) + [self.wakeup_read]):
+                if fd == self.wakeup_read:
+                    os.read(fd, 4096)
+                elif fd in self.pipes:
+                    self.read(fd)
+
+        for process, name in set(six.itervalues(self.pipes)):
+            if process.popen.poll() is None:
+                process.popen.kill()
+        if self.jobserver is not None:
+            for process in set(p for p, name in six.itervalues(self.pipes)):
+                self.jobserver.release(process.token)
+            for command, callback, token in self.waiting:
+                self.jobserver.release(token)
+
+    def start(self, command, callback, token=None):
+        process = Process(command, callback)
+        process.token = token
+        kw = dict(command.kw)
+        output = kw.pop('output', None)
+        if self.jobserver is not None and 'env' not in kw:
+            kw['env'] = self.jobserver.environ()
+        if log.isEnabledFor(logging.INFO):
+            log.info(command.args if isinstance(command.args, six.string_types) else ' '.join(command.args))
+        try:
+            process.popen = subprocess.Popen(
+                command.args,
+                stdout=subprocess.PIPE,
+                stdin=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                **kw
+            )
+            process.popen.stdin.close()
+            if output is not None:
+                process.writer = atomic_write(output)
+                process.file = process.writer.__enter__()
+        except Exception as e:
+            if process.popen is not None:
+                process.popen.kill()
+                process.popen.wait()
+            return self.finish(process, e)
+
+        for name in ('stdout', 'stderr'):
+            self.pipes[getattr(process.popen, name).fileno()] = (process, name)
+            process.open += 1
+
+    def read(self, fd):
+        process, name = self.pipes[fd]
+        chunk = os.read(fd, 65536)
+        if chunk:
+            try:
+                process.write(name, chunk)
+                return
+            except Exception as e:
+                # can't write the output file. stop reading and kill the command
+                error = e
+                process.popen.kill()
+        else:
+            error = None
+
+        del self.pipes[fd]
+        getattr(process.popen, name).close()
+        process.open -= 1
+        if error is not None:
+            for other in [p for p, (proc, n) in six.iteritems(self.pipes) if proc is process]:
+                del self.pipes[other]
+                process.open -= 1
+            process.popen.wait()
+            self.finish(process, error)
+        elif not process.open:
+            # both pipes are closed, so the command is about to exit
+            process.popen.wait()
+            self.finish(process)
+
+    def finish(self, process, error=None):
+        """
+        Replace the output file if everything went well and report the result
+        """
+        popen = process.popen
+        stdout = b''.join(process.stdout) if process.file is None else None
+        stderr = b''.join(process.stderr)
+        if error is None and popen.returncode != 0:
+            error = CompilerError((process.command.args,), popen.returncode, stdout, stderr)
+
+        if process.writer is not None:
+            try:
+                if error is None:
+                    process.writer.__exit__(None, None, None)
+                else:
+                    # removes the temporary file
+                    process.writer.__exit__(type(error), error, None)
+            except Exception as e:
+                error = e
+
+        with self.lock:
+            self.running -= 1
+        if self.jobserver is not None:
+            self.jobserver.release(process.token)
+        try:
+            if error is None:
+                process.callback((stdout, stderr))
+            else:
+                process.callback(error=error)
+        except Exception:
+            log.exception('Error in command callback')
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.tokens.notify_all()
+        os.write(self.wakeup_write, b'x')
+        self.thread.join()
+        # a helper may still be waking the reactor thread up
+        self.helpers.shutdown()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+
+class AsyncExecutor(object):
+    """
+    Runs tasks whose compilers only execute commands on a CommandReactor, without a thread
+    per task, and everything else on ``executor``
+    """
+
+    def __init__(self, executor, reactor):
+        self.executor = executor
+        self.reactor = reactor
+        # tasks running on the reactor
+        self.active = 0
+        self.condition = threading.Condition()
+        self._shutdown = False
+        super(AsyncExecutor, self).__init__()
+
+    @property
+    def tracer(self):
+        return self.executor.tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self.executor.tracer = tracer
+
+    def submit(self, runner):
+        task = runner.task
+        if not (hasattr(task, 'asynchronous') and task.asynchronous()):
+            return self.executor.submit(runner)
+        if self._shutdown:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        if not runner.future.set_running_or_notify_cancel():
+            return runner.future
+
+        tracer = self.tracer
+        if runner.waiting_for and runner.scheduled is not None:
+            tracer.interval(task.output_file, runner.scheduled, cat='dependencies')
+
+        with self.condition:
+            self.active += 1
+
+        def finished(f):
+            try:
+                if f.exception() is not None:
+                    runner.future.set_exception(f.exception())
+                else:
+                    runner.future.set_result(f.result())
+            finally:
+                # after the dependents were submitted, so wait() can't miss them
+                with self.condition:
+                    self.active -= 1
+                    self.condition.notify_all()
+
+        future = Future()
+        future.add_done_callback(finished)
+        task.build_async(self.reactor, future)
+        return runner.future
+
+    def wait(self):
+        while True:
+            self.executor.wait()
+            with self.condition:
+                while self.active and not self._shutdown:
+                    self.condition.wait(1)
+            if self._shutdown or not self.executor.busy():
+                return
+
+    def shutdown(self, wait=True):
+        self._shutdown = True
+        self.executor.shutdown(wait)
+        self.reactor.close()
@@ -1,13 +1,11 @@
 from concurrent.futures._base import Future, CANCELLED_AND_NOTIFIED, CANCELLED
+import os
 import six
 import logging
+import threading
+import time
 from collections import OrderedDict
 
-try:
-    from functools import reduce
-except ImportError:
-    pass
-
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +19,13 @@ class TaskFuture(Future):
             return self._state in [CANCELLED, CANCELLED_AND_NOTIFIED] or self._exception is not None
 
 
+class CyclicDependencyError(Exception):
+    def __init__(self, cycle):
+        self.cycle = cycle
+        super(CyclicDependencyError, self).__init__(
+            u'Cyclic dependency: {0}'.format(u' -> '.join(cycle)))
+
+
 class DiGraph(OrderedDict):
     def __init__(self, roots=None):
         super(DiGraph, self).__init__()
@@ -46,31 +51,136 @@ class TaskGraph(object):
         super(TaskGraph, self).__init__()
         self.graph = DiGraph(roots=roots)
         self.tasks = {}
+        # reverse arcs: file -> tasks using it as a dependency
+        self.consumers = {}
+        # output file -> inputs the task discovered that it doesn't declare
+        self.implicit = {}
 
     def arc(self, task):
         self.graph.arc(task)
         self.tasks[task.output_file] = task
+        for source in task.dependent:
+            self.consumers.setdefault(source, OrderedDict())[task] = True
+
+    def imply(self, task, files):
+        """
+        Make ``task`` depend on the discovered ``files`` as well as its declared dependencies,
+        replacing the files given before
+        """
+        key = task.output_file
+        declared = set(task.dependent)
+        for source in self.implicit.pop(key, ()):
+            self.graph[key].discard(source)
+            self.consumers.get(source, {}).pop(task, None)
+
+        files = [f for f in files if f not in declared and f != key]
+        if files:
+            self.implicit[key] = files
+        for source in files:
+            self.graph[key].add(source)
+            self.graph.setdefault(source, set())
+            self.consumers.setdefault(source, OrderedDict())[task] = True
+
+    def sources(self, task):
+        """
+        Return the declared and discovered dependencies of ``task``
+        """
+        return list(task.dependent) + self.implicit.get(task.output_file, [])
+
+    def downstream(self, tasks):
+        """
+        Return ``tasks`` and every task that depends on their output, directly or not
+        """
+        found = OrderedDict((task, True) for task in tasks)
+        stack = list(found)
+        while stack:
+            task = stack.pop()
+            for consumer in self.consumers.get(task.output_file, ()):
+                if consumer not in found:
+                    found[consumer] = True
+                    stack.append(consumer)
+        return list(found)
+
+    def upstream(self, outputs):
+        """
+        Return the tasks producing ``outputs`` and every task they depend on, directly or not
 
-    def toposort(self):
-        if self.graph:
-            data = DiGraph()
-            map(data.__setitem__, self.graph.keys(), self.graph.values())
-
-            for k, v in data.items():
-                v.discard(k)   # Ignore self dependencies
-            extra_items_in_deps = reduce(set.union, data.values()) - set(data.keys())
-            data.update(dict([(k, set()) for k in extra_items_in_deps]))
-            while True:
-                ordered = set(output_file for output_file, dep in six.iteritems(data) if not dep)
-                if not ordered:
-                    break
-                for el in ordered:
-                    task = self.tasks.get(el)
-                    if task:
-                        yield task
-                data = dict([(item, (dep - ordered)) for item, dep in six.iteritems(data)
-                            if item not in ordered])
-            assert not data, "Data has a cyclic dependency"
+        Raises ValueError if no task produces one of ``outputs``.
+        """
+        by_path = dict((os.path.normpath(output_file), output_file) for output_file in self.tasks)
+        found = OrderedDict()
+        stack = []
+        for output in outputs:
+            key = by_path.get(os.path.normpath(output))
+            if key is None:
+                raise ValueError(u'No task builds {0}'.format(output))
+            stack.append(key)
+        while stack:
+            key = stack.pop()
+            task = self.tasks.get(key)
+            if task is None or task in found:
+                continue
+            found[task] = True
+            stack.extend(self.graph[key])
+        return list(found)
+
+    def toposort(self, tasks=None):
+        """
+        Yield tasks so that every task comes after the tasks producing its dependencies.
+        If ``tasks`` is given, only those are sorted.
+
+        Raises CyclicDependencyError if the graph has a cycle.
+        """
+        if tasks is None:
+            nodes = self.graph
+        else:
+            nodes = OrderedDict((task.output_file, self.graph[task.output_file]) for task in tasks)
+
+        # number of unfinished dependencies for every node and the reverse arcs to decrement them
+        pending = OrderedDict()
+        consumers = {}
+        for output_file, sources in six.iteritems(nodes):
+            pending.setdefault(output_file, 0)
+            for source in sources:
+                if source == output_file or source not in nodes:
+                    # ignore self dependencies and anything outside of the sorted tasks
+                    continue
+                pending[output_file] += 1
+                pending.setdefault(source, 0)
+                consumers.setdefault(source, []).append(output_file)
+
+        # a stack finishes a chain before starting the next one
+        ready = [node for node, count in six.iteritems(pending) if not count]
+        visited = 0
+        while ready:
+            node = ready.pop()
+            visited += 1
+            task = self.tasks.get(node)
+            if task:
+                yield task
+            for consumer in consumers.get(node, ()):
+                pending[consumer] -= 1
+                if not pending[consumer]:
+                    ready.append(consumer)
+
+        if visited != len(pending):
+            raise CyclicDependencyError(self.find_cycle(
+                [node for node, count in six.iteritems(pending) if count]))
+
+    def find_cycle(self, nodes):
+        """
+        Return a list of nodes forming a cycle within ``nodes``, starting and ending with the same node
+        """
+        # every node left over by toposort has a dependency that is also left over,
+        # so following them must eventually revisit a node
+        node = nodes[0]
+        nodes = set(nodes)
+        seen = OrderedDict()
+        while node not in seen:
+            seen[node] = True
+            node = next(s for s in self.graph[node] if s in nodes and s != node)
+        path = list(seen)
+        return path[path.index(node):] + [node]
 
 
 class Runner(object):
@@ -85,29 +195,125 @@ class Runner(object):
 
         # the callable to run
         self.task = task
+        # runners with a higher priority are started first
+        self.priority = 0
+        # when this started waiting for dependencies
+        self.scheduled = None
+        # number of dependencies still running, None until scheduled
+        self.pending = None
+        # True if a dependency failed or was cancelled
+        self.failed = False
+        # if True, this is only run when a dependency's output changed
+        self.cutoff = False
+        # True if a dependency's output changed
+        self.changed = False
+        # an earlier runner of the same task that has to finish first, whatever its result
+        self.follows = None
+        # dependencies of a replaced runner that newer runners build again. a changed output
+        # still counts, a failure doesn't because the newer runners try again
+        self.inherited = []
+        # True if a newer runner of the same task took over before this one was submitted
+        self.replaced = False
+        self.lock = threading.Lock()
 
         super(Runner, self).__init__()
 
-    def schedule(self, executor, _reschedule=False):
+    def schedule(self, executor):
         """
-        Try to schedule this Runner with the executor or wait for dependencies
+        Submit this Runner to the executor once every dependency has finished. If one of them
+        fails, this Runner is cancelled instead, so anything waiting for it gives up as well.
+        If ``cutoff`` is set and no dependency changed its output, this Runner finishes without
+        running. Scheduling more than once has no effect.
         """
-        if self.future.done():
-            return
-
-        if False not in [r.future.done() for r in self.waiting_for]:
-            if any(r.future.exception() for r in self.waiting_for):
-                # a dependency failed. done() is True but an exception is set
+        with self.lock:
+            if self.pending is not None or self.future.done():
                 return
-            executor.submit(self)
-            return
+            self.scheduled = time.time()
+            dependencies = list(OrderedDict((r, True) for r in self.waiting_for))
+            inherited = list(self.inherited)
+            # one extra count for this call, so nothing is submitted while callbacks are added
+            self.pending = len(dependencies) + len(inherited) + 1 + (self.follows is not None)
 
         def dep_finished_callback(future):
-            self.schedule(executor, _reschedule=True)
+            self.finished(executor, future)
 
-        if not _reschedule:
-            for runner in self.waiting_for:
-                runner.future.add_done_callback(dep_finished_callback)
+        def inherited_finished_callback(future):
+            self.finished(executor, future, failures=False)
+
+        for runner in dependencies:
+            runner.future.add_done_callback(dep_finished_callback)
+        for runner in inherited:
+            runner.future.add_done_callback(inherited_finished_callback)
+        if self.follows is not None:
+            self.follows.future.add_done_callback(lambda future: self.finished(executor, None))
+        self.finished(executor, None)
+
+    def replace(self):
+        """
+        Keep this Runner from running because a newer one of the same task will. Returns False
+        if it's too late because it has been submitted already.
+        """
+        with self.lock:
+            if not self.pending:
+                return False
+            self.replaced = True
+            return True
+
+    def stale(self):
+        """
+        Return True if the task is out of date regardless of its dependencies, like when its
+        output was deleted or its last run failed
+        """
+        check = getattr(self.task, 'check', None)
+        if check is None:
+            return True
+        try:
+            return check()[0]
+        except Exception:
+            # let it run and report the problem
+            return True
+
+    def take_over(self, previous, runners):
+        """
+        Run instead of ``previous``, a replaced Runner of the same task, without losing what
+        it was waiting for. ``runners`` are the Runners scheduled along with this one, by output file.
+        """
+        self.cutoff = self.cutoff and previous.cutoff
+        with previous.lock:
+            self.changed = self.changed or previous.changed
+        for runner in previous.waiting_for:
+            if runners.get(runner.task.output_file, runner) is not runner:
+                # built again by a newer runner this one waits for already
+                self.inherited.append(runner)
+            elif runner not in self.waiting_for:
+                # still running or queued, the output isn't there yet
+                self.waiting_for.append(runner)
+        self.inherited.extend(previous.inherited)
+
+    def finished(self, executor, future, failures=True):
+        """
+        Count down a finished dependency and submit or cancel this Runner after the last one.
+        If ``failures`` is False, a failed dependency doesn't cancel this Runner.
+        """
+        with self.lock:
+            if future is not None:
+                if future.cancelled() or future.exception() is not None:
+                    self.failed = self.failed or failures
+                elif future.result() is not False:
+                    # anything but a compiler reporting an unchanged output counts as a change
+                    self.changed = True
+            self.pending -= 1
+            if self.pending:
+                return
+
+        if self.failed or self.replaced:
+            self.future.cancel()
+            self.future.set_running_or_notify_cancel()
+        elif self.cutoff and not self.changed and not self.stale():
+            log.debug(u'Skipping %s, dependencies are unchanged', getattr(self.task, 'output_file', self.task))
+            self.future.set_result(False)
+        else:
+            executor.submit(self)
 
 
 class Scheduler(object):
@@ -115,39 +321,74 @@ class Scheduler(object):
     An abstraction for a single run. Tracks the run status of compiler tasks and their dependencies.
     """
 
-    def __init__(self):
+    def __init__(self, durations=None):
+        """
+        ``durations`` - run times of tasks from previous builds by output file, used to start
+            the longest chains of tasks first
+        """
         # the dependency graph of all tasks stored by target (string path) and a set of tasks depending on the target
         self.targets = TaskGraph()
+        self.durations = durations or {}
 
         super(Scheduler, self).__init__()
 
-    def load(self, compilers):
+    def load(self, compilers, implicit=None):
         """
         Load tasks and calculate dependencies
+
+        ``implicit`` - a function returning the inputs a task discovered the last time it ran,
+            like ``BuildDatabase.implicit``
         """
         # make an arc from every dependent file to the task that creates it
         for c in compilers:
             self.targets.arc(c)
+            if implicit is not None:
+                files = implicit(c)
+                if files:
+                    self.targets.imply(c, files)
 
         return self
 
-    def run(self):
+    def run(self, tasks=None, changed=None):
         """
-        Get runners for the scheduled tasks
+        Get runners for the scheduled tasks, or only for ``tasks`` if given. Runners are
+        returned in dependency order.
+
+        ``changed`` - the tasks known to be out of date. If given, every other runner only runs
+            when one of its dependencies produced a new output.
         """
+        changed = set(changed) if changed is not None else None
 
         # create runners for all of the compiler tasks
-        runners = {}
+        runners = OrderedDict()
 
         # build dependency lists for each runner
-        for task in self.targets.toposort():
+        for task in self.targets.toposort(tasks):
             runner = Runner(task)
             runners[task.output_file] = runner
 
-            for dep in task.dependent:
+            for dep in self.targets.sources(task):
                 wait_for = runners.get(dep)
                 # if not present there's nothing in the schedule that produces this file. that's normal
                 if wait_for:
                     runner.waiting_for.append(wait_for)
 
+            runner.cutoff = changed is not None and task not in changed and bool(runner.waiting_for)
+
+        self.prioritize(runners)
         return runners
+
+    def prioritize(self, runners):
+        """
+        Set the priority of every runner to the expected time from its start to the end of the
+        longest chain of tasks depending on it. Tasks that never ran count as an average one.
+        """
+        default = (sum(self.durations.values()) / len(self.durations)) if self.durations else 1.0
+
+        # longest path downstream of a runner, filled in by its dependents which come later
+        longest = {}
+        for runner in reversed(list(six.itervalues(runners))):
+            duration = self.durations.get(os.path.normpath(runner.task.output_file), default)
+            runner.priority = duration + longest.get(runner, 0)
+            for dep in runner.waiting_for:
+                longest[dep] = max(longest.get(dep, 0), runner.priority)
@@ -0,0 +1,102 @@
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+    """
+    Records a timeline of a build as Chrome trace events, which can be loaded in Perfetto or
+    chrome://tracing.
+
+    Work done by a thread is recorded with ``span()``. Waiting, like a task sitting in the queue,
+    isn't done by any thread and is recorded with ``interval()`` instead.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.pid = os.getpid()
+        self.ids = itertools.count(1)
+        # thread ident -> small number, so threads are listed in the order they did something
+        self.threads = {}
+        super(Tracer, self).__init__()
+
+    def timestamp(self, t):
+        # microseconds since the start of the build
+        return int((t - self.start) * 1000000)
+
+    def tid(self):
+        ident = threading.current_thread().ident
+        tid = self.threads.get(ident)
+        if tid is None:
+            with self.lock:
+                tid = self.threads.setdefault(ident, len(self.threads) + 1)
+                self.events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                    'args': {'name': threading.current_thread().name},
+                })
+        return tid
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def complete(self, name, start, end=None, cat='task', **args):
+        """
+        Record work done by the current thread from ``start`` to ``end`` (defaults to now)
+        """
+        end = time.time() if end is None else end
+        self.add({
+            'name': name, 'cat': cat, 'ph': 'X', 'pid': self.pid, 'tid': self.tid(),
+            'ts': self.timestamp(start), 'dur': self.timestamp(end) - self.timestamp(start),
+            'args': args,
+        })
+
+    @contextlib.contextmanager
+    def span(self, name, cat='task', **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.complete(name, start, cat=cat, **args)
+
+    def interval(self, name, start, end=None, cat='wait', **args):
+        """
+        Record a period from ``start`` to ``end`` (defaults to now) that no thread was working on
+        """
+        end = time.time() if end is None else end
+        id = next(self.ids)
+        for ph, t in (('b', start), ('e', end)):
+            self.add({
+                'name': name, 'cat': cat, 'ph': ph, 'id': id, 'pid': self.pid, 'tid': 0,
+                'ts': self.timestamp(t), 'args': args if ph == 'b' else {},
+            })
+
+    def write(self, filename):
+        with self.lock:
+            data = json.dumps({'traceEvents': self.events, 'displayTimeUnit': 'ms'})
+        with open(filename, 'wb') as f:
+            f.write(data.encode('utf-8'))
+
+
+class NullTracer(object):
+    """
+    A Tracer that doesn't record anything
+    """
+
+    def complete(self, name, start, end=None, cat='task', **args):
+        pass
+
+    @contextlib.contextmanager
+    def span(self, name, cat='task', **args):
+        yield
+
+    def interval(self, name, start, end=None, cat='wait', **args):
+        pass
+
+    def write(self, filename):
+        pass
@@ -1,6 +1,12 @@
+import fnmatch
 import os
+import select
+import six
+import threading
+import time
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
+from chimney.compilers import temporary_of
 
 
 class Observation(object):
@@ -26,18 +32,229 @@ class Observation(object):
         return self.path != other.path or self.type != other.type
 
 
+class ChangeQueue(object):
+    """
+    A thread safe queue of Observations. The watchdog thread puts changes and the
+    main thread blocks in ``wait()`` until there is something to process.
+
+    Waiting is a ``select()`` on a pipe that ``put()`` writes to, so an idle watcher doesn't wake
+    up until something changes and Control-C still interrupts it. Windows can't select on pipes
+    and falls back to an Event.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changes = []
+        # time of the most recent change
+        self.last = 0
+        # True while a wakeup is pending, so a burst of changes can't fill the pipe
+        self.signaled = False
+        self.closed = False
+        if os.name == 'nt':
+            self.event = threading.Event()
+        else:
+            self.event = None
+            self.wakeup_read, self.wakeup_write = os.pipe()
+        super(ChangeQueue, self).__init__()
+
+    def put(self, obs):
+        with self.lock:
+            self.changes.append(obs)
+            self.last = time.time()
+            if self.event is not None:
+                self.event.set()
+            elif not self.signaled and not self.closed:
+                os.write(self.wakeup_write, b'x')
+            self.signaled = True
+
+    def wait(self, timeout=None, debounce=0):
+        """
+        Block until there are changes and nothing new has arrived for ``debounce`` seconds.
+        Gives up after ``timeout`` seconds without any change. Returns True if there are changes.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                if self.changes:
+                    break
+            if timeout is None:
+                self.sleep(None)
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.sleep(remaining)
+
+        # let a burst of changes settle so it's processed as one batch
+        while True:
+            with self.lock:
+                remaining = self.last + debounce - time.time()
+            if remaining <= 0:
+                return True
+            self.sleep(remaining)
+
+    def sleep(self, timeout):
+        """
+        Block until ``put()`` is called or ``timeout`` seconds have passed
+        """
+        if self.event is not None:
+            # an Event wait without a timeout can't be interrupted by Control-C
+            self.event.wait(1 if timeout is None else timeout)
+            self.event.clear()
+        elif select.select([self.wakeup_read], [], [], timeout)[0]:
+            os.read(self.wakeup_read, 4096)
+        with self.lock:
+            self.signaled = False
+
+    def drain(self):
+        """
+        Remove and return all queued changes
+        """
+        with self.lock:
+            changes, self.changes = self.changes, []
+        return changes
+
+    def close(self):
+        with self.lock:
+            if self.event is None and not self.closed:
+                os.close(self.wakeup_read)
+                os.close(self.wakeup_write)
+            self.closed = True
+
+    def __len__(self):
+        with self.lock:
+            return len(self.changes)
+
+
 class Watcher(FileSystemEventHandler):
-    def __init__(self, change_handler, path=os.curdir):
+    def __init__(self, change_handler, path=os.curdir, recursive=True, include=None, exclude=None,
+                 ignore=None):
+        """
+        Watch for filesystem changes
+
+        ``change_handler`` - called with an Observation for every change
+        ``path`` - a directory or a list of directories to watch
+        ``recursive`` - also watch subdirectories. If False, directories created in a watched one
+            are watched as well, so files put in a new subdirectory of a globbed tree are seen
+        ``include`` - shell patterns. If given, only matching files are reported
+        ``exclude`` - shell patterns of files to never report
+        ``ignore`` - a collection of absolute paths to never report, like the files chimney writes.
+            The temporary files they are written to first aren't reported either
+        """
         self.change_handler = change_handler
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.ignore = ignore or ()
+        # directory -> watchdog watch
+        self.watches = {}
 
         self.observer = Observer()
-        self.observer.schedule(self, path, recursive=True)
+        self.watch(path)
         self.observer.start()
 
         super(Watcher, self).__init__()
 
+    def watch(self, path):
+        """
+        Change the watched directories to ``path``, a directory or a list of them
+        """
+        paths = set([path] if isinstance(path, six.string_types) else path)
+        for p in set(self.watches) - paths:
+            self.observer.unschedule(self.watches.pop(p))
+        for p in paths - set(self.watches):
+            self.watches[p] = self.observer.schedule(self, p, recursive=self.recursive)
+
+    def accept(self, filename):
+        """
+        Return True if changes to ``filename`` should be reported
+        """
+        abs = os.path.abspath(filename)
+        if abs in self.ignore or temporary_of(abs) in self.ignore:
+            return False
+
+        rel = os.path.relpath(abs)
+        if self.include and not any(fnmatch.fnmatch(rel, p) for p in self.include):
+            return False
+        if self.exclude and any(fnmatch.fnmatch(rel, p) for p in self.exclude):
+            return False
+        return True
+
     def on_any_event(self, event):
-        self.change_handler(Observation(event.src_path, event.event_type))
+        if event.event_type == 'moved':
+            # editors save by renaming a temporary file over the original. report the two ends
+            # separately so the batch shows the original being replaced
+            if self.accept(event.src_path):
+                self.change_handler(Observation(event.src_path, 'deleted'))
+            if self.accept(event.dest_path):
+                self.change_handler(Observation(event.dest_path, 'created'))
+        elif self.accept(event.src_path):
+            self.change_handler(Observation(event.src_path, event.event_type))
+
+        if event.is_directory and not self.recursive:
+            if event.event_type == 'moved':
+                self.created(event.dest_path)
+            elif event.event_type == 'created':
+                self.created(event.src_path)
+
+    def created(self, directory):
+        """
+        Watch a directory that appeared in a watched one. Anything put in it before the watch
+        started is reported as created.
+        """
+        if directory in self.watches or not os.path.isdir(directory):
+            return
+        self.watches[directory] = self.observer.schedule(self, directory, recursive=False)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in sorted(names):
+            filename = os.path.join(directory, name)
+            if self.accept(filename):
+                self.change_handler(Observation(filename, 'created'))
+            if os.path.isdir(filename):
+                self.created(filename)
 
     def stop(self):
         self.observer.stop()
+
+
+def net_changes(batch):
+    """
+    Reduce a batch of Observations to one per path, for what changed between the start and the
+    end of the batch. A file that was deleted or moved away and created again was modified, and
+    a file created and removed again didn't change at all.
+    """
+    first, last = {}, {}
+    for obs in batch:
+        key = os.path.abspath(obs.path)
+        first.setdefault(key, obs)
+        last[key] = obs
+
+    changes = []
+    for key, obs in six.iteritems(last):
+        existed = first[key].type != 'created'
+        exists = obs.type != 'deleted'
+        if existed and exists:
+            changes.append(Observation(obs.path, 'modified'))
+        elif exists:
+            changes.append(Observation(obs.path, 'created'))
+        elif existed:
+            changes.append(Observation(obs.path, 'deleted'))
+    return changes
+
+
+def watch_directories(filenames):
+    """
+    Return the smallest set of directories to watch (without recursion) to see changes to ``filenames``
+    """
+    directories = set()
+    for filename in filenames:
+        directory = os.path.dirname(os.path.abspath(filename))
+        # watch the closest parent that exists to see the directory being created
+        while not os.path.isdir(directory) and os.path.dirname(directory) != directory:
+            directory = os.path.dirname(directory)
+        directories.add(directory)
+    return sorted(directories)
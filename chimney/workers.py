@@ -0,0 +1,186 @@
+import json
+import logging
+import subprocess
+import threading
+from chimney.compilers import CompilerError
+
+
+log = logging.getLogger(__name__)
+
+
+class WorkerError(Exception):
+    pass
+
+
+class PersistentWorker(object):
+    """
+    A long running compiler process that handles one request at a time.
+
+    Requests and responses are single lines of JSON on the worker's stdin and stdout::
+
+        {"request_id": 1, "arguments": ["--print", "wood.coffee"]}
+        {"request_id": 1, "exit_code": 0, "stdout": "...", "stderr": ""}
+
+    ``arguments`` is the command line the compiler would have run, without the program name.
+    Anything the worker writes to its stderr goes straight to chimney's stderr.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.requests = 0
+        log.info(u'Starting worker: %s', u' '.join(command))
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        super(PersistentWorker, self).__init__()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def request(self, arguments):
+        """
+        Send a request and wait for the response. Returns exit code, stdout and stderr.
+        """
+        self.requests += 1
+        line = json.dumps({'request_id': self.requests, 'arguments': list(arguments)})
+        try:
+            self.process.stdin.write(line.encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+            response = self.process.stdout.readline()
+        except (IOError, OSError) as e:
+            raise WorkerError(u'Worker {0} failed: {1}'.format(self.command, e))
+
+        if not response:
+            raise WorkerError(u'Worker {0} exited with {1}'.format(self.command, self.process.wait()))
+
+        data = json.loads(response.decode('utf-8'))
+        if data.get('request_id') != self.requests:
+            raise WorkerError(u'Worker {0} answered request {1}, expected {2}'.format(
+                self.command, data.get('request_id'), self.requests))
+        return (
+            data.get('exit_code', 0),
+            data.get('stdout', u'').encode('utf-8'),
+            data.get('stderr', u'').encode('utf-8'),
+        )
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            log.info('Failed to stop worker', exc_info=True)
+
+    def terminate(self):
+        """
+        Kill the worker, even in the middle of a request
+        """
+        if self.alive():
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.process.wait()
+
+
+class WorkerPool(object):
+    """
+    Persistent workers for every worker command, started as needed. At most ``size`` workers
+    run for each command.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.condition = threading.Condition()
+        # command -> workers waiting for a request
+        self.idle = {}
+        # command -> number of workers started
+        self.started = {}
+        # every worker that is running, idle or not
+        self.workers = set()
+        self.closed = False
+        super(WorkerPool, self).__init__()
+
+    def acquire(self, command):
+        command = tuple(command)
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise WorkerError(u'Worker pool is closed')
+                idle = self.idle.setdefault(command, [])
+                if idle:
+                    return idle.pop()
+                if self.started.get(command, 0) < self.size:
+                    self.started[command] = self.started.get(command, 0) + 1
+                    break
+                self.condition.wait()
+
+        try:
+            worker = PersistentWorker(list(command))
+        except Exception:
+            self.discard(command)
+            raise
+        with self.condition:
+            closed = self.closed
+            if not closed:
+                self.workers.add(worker)
+        if closed:
+            worker.terminate()
+            raise WorkerError(u'Worker pool is closed')
+        return worker
+
+    def release(self, worker):
+        with self.condition:
+            closed = self.closed
+            if not closed:
+                self.idle.setdefault(tuple(worker.command), []).append(worker)
+                self.condition.notify()
+        if closed:
+            worker.stop()
+
+    def discard(self, command, worker=None):
+        with self.condition:
+            command = tuple(command)
+            self.started[command] = max(self.started.get(command, 0) - 1, 0)
+            self.workers.discard(worker)
+            self.condition.notify()
+
+    def execute(self, command, args):
+        """
+        Run ``args`` with a worker started with ``command``. Works like ``local()``.
+        """
+        worker = self.acquire(command)
+        try:
+            returncode, stdout, stderr = worker.request(args[1:])
+        except Exception:
+            # don't reuse a worker in an unknown state
+            worker.terminate()
+            self.discard(command, worker)
+            raise
+
+        if worker.alive():
+            self.release(worker)
+        else:
+            self.discard(command, worker)
+
+        if returncode != 0:
+            raise CompilerError(args, returncode, stdout, stderr)
+        return stdout, stderr
+
+    def close(self):
+        """
+        Stop the idle workers and kill the ones still handling a request
+        """
+        with self.condition:
+            idle = set(w for workers in self.idle.values() for w in workers)
+            busy = self.workers - idle
+            self.idle = {}
+            self.started = {}
+            self.workers = set()
+            self.closed = True
+            self.condition.notify_all()
+        for worker in idle:
+            worker.stop()
+        for worker in busy:
+            worker.terminate()
@@ -0,0 +1,45 @@
+import contextlib
+import os
+import shutil
+import six
+import tempfile
+from chimney.compilers import Compiler
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    """
+    A new directory that is removed with everything in it after the block
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def write(filename, data=b''):
+    """
+    Write ``data``, text or bytes, to ``filename`` and create the directories it is in
+    """
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+class concat(Compiler):
+    """
+    Writes its sources and the inputs it discovers one after the other, and counts its runs
+    """
+    runs = 0
+
+    def run(self):
+        concat.runs += 1
+        with open(self.output_file, 'wb') as out:
+            for source in list(self.sources()) + self.discover():
+                with open(source, 'rb') as f:
+                    out.write(f.read())
@@ -1,19 +1,45 @@
+import os
+import threading
+import mock
 from mock import MagicMock
 from nose.tools import eq_
-from chimney.api import Maker, watch
+from chimney.api import Maker, make, watch
 from chimney.compilers import Compiler
 from chimney.watch import Observation
+from tests.fixtures import temporary_directory, write
 
 
-def test_watch_multi():
+# the watch tests patch it, to keep watching after the first build
+close = Maker.close
+
+
+def test_make_targets():
+    # only the requested output and what it is built from
+    class coffee(Compiler):
+        run = MagicMock()
+
+    class uglify(Compiler):
+        run = MagicMock()
+
+    tasks = [
+        coffee('one.js', ['one.coffee']),
+        coffee('two.js', ['two.coffee']),
+        uglify('one.min.js', 'one.js'),
+        uglify('two.min.js', 'two.js'),
+    ]
+    make(*tasks, database=None, targets=['one.min.js'])
+    eq_(coffee.run.call_count, 1)
+    eq_(uglify.run.call_count, 1)
+
+
+@mock.patch.object(Maker, 'close')   # don't let it shutdown yet
+@mock.patch.object(Maker, 'sleep')
+def test_watch_multi(sleep_mock, close_mock):
     # make sure one change to a shared dependency recompiles both
     class coffee(Compiler):
         run = MagicMock()
 
-    close = Maker.close  # don't let it shutdown yet
-    Maker.close = MagicMock()
-    Maker.sleep = MagicMock()
-    Maker.sleep.return_value = False
+    sleep_mock.return_value = False
 
     def create_tasks():
         return [
@@ -21,7 +47,7 @@ def test_watch_multi():
             coffee('waterlog.js', ['wood.coffee', 'water.coffee']),
         ]
 
-    maker = watch(create_tasks, reload_patterns=['*.coffee', '*.js'])
+    maker = watch(create_tasks, reload_patterns=['*.coffee', '*.js'], database=None)
 
     # compiles smoke.js, waterlog.js
     eq_(coffee.run.call_count, 2)
@@ -40,3 +66,277 @@ def test_watch_multi():
 
     close(maker)
     maker.watcher.stop()
+
+
+@mock.patch.object(Maker, 'close')   # don't let it shutdown yet
+@mock.patch.object(Maker, 'sleep')
+def test_watch_downstream(sleep_mock, close_mock):
+    # a change rebuilds everything downstream of it and nothing else
+    class coffee(Compiler):
+        run = MagicMock()
+
+    class uglify(Compiler):
+        run = MagicMock()
+
+    class gzip(Compiler):
+        run = MagicMock()
+
+    sleep_mock.return_value = False
+
+    def create_tasks():
+        return [
+            coffee('smoke.js', ['wood.coffee', 'fire.coffee']),
+            uglify('smoke.min.js', 'smoke.js'),
+            gzip('smoke.min.js.gz', 'smoke.min.js'),
+            coffee('water.js', ['water.coffee']),
+        ]
+
+    maker = watch(create_tasks, reload_patterns=['*.coffee', '*.js'], database=None)
+    eq_(coffee.run.call_count, 2)
+    eq_(uglify.run.call_count, 1)
+    eq_(gzip.run.call_count, 1)
+
+    maker.watcher.change_handler(Observation('wood.coffee', 'modified'))
+    maker.process_changes()
+    maker.executor.wait()
+    eq_(coffee.run.call_count, 3)
+    eq_(uglify.run.call_count, 2)
+    eq_(gzip.run.call_count, 2)
+
+    maker.watcher.change_handler(Observation('smoke.min.js', 'modified'))
+    maker.process_changes()
+    maker.executor.wait()
+    eq_(coffee.run.call_count, 3)
+    eq_(uglify.run.call_count, 2)
+    eq_(gzip.run.call_count, 3)
+
+    close(maker)
+    maker.watcher.stop()
+
+
+@mock.patch.object(Maker, 'close')   # don't let it shutdown yet
+@mock.patch.object(Maker, 'sleep')
+def test_watch_reload(sleep_mock, close_mock):
+    # reloading only builds new and changed tasks and keeps the executor and watcher
+    class coffee(Compiler):
+        run = MagicMock()
+
+    class uglify(Compiler):
+        run = MagicMock()
+
+    sleep_mock.return_value = False
+
+    maker = watch(lambda: [
+        coffee('smoke.js', ['wood.coffee']),
+        uglify('smoke.min.js', 'smoke.js'),
+    ], database=None)
+    executor = maker.executor
+    watcher = maker.watcher
+    eq_(coffee.run.call_count, 1)
+    eq_(uglify.run.call_count, 1)
+
+    maker.reload([
+        coffee('smoke.js', ['wood.coffee']),
+        uglify('smoke.min.js', 'smoke.js'),
+        coffee('water.js', ['water.coffee']),
+    ])
+    maker.executor.wait()
+    eq_(coffee.run.call_count, 2)
+    eq_(uglify.run.call_count, 1)
+
+    # a new dependency for smoke.js rebuilds it and smoke.min.js
+    maker.reload([
+        coffee('smoke.js', ['wood.coffee', 'fire.coffee']),
+        uglify('smoke.min.js', 'smoke.js'),
+        coffee('water.js', ['water.coffee']),
+    ])
+    maker.executor.wait()
+    eq_(coffee.run.call_count, 3)
+    eq_(uglify.run.call_count, 2)
+    assert os.path.abspath('fire.coffee') in maker.by_source
+
+    assert maker.executor is executor
+    assert maker.watcher is watcher
+
+    close(maker)
+    maker.watcher.stop()
+
+
+@mock.patch.object(Maker, 'close')   # don't let it shutdown yet
+@mock.patch.object(Maker, 'sleep')
+def test_watch_coalesce(sleep_mock, close_mock):
+    # changes while a task runs add up to one more run after it, never two at once
+    started = threading.Event()
+    release = threading.Event()
+    running = []
+    overlapped = []
+
+    class coffee(Compiler):
+        calls = 0
+
+        def run(self):
+            running.append(self)
+            if len(running) > 1:
+                overlapped.append(self)
+            coffee.calls += 1
+            if coffee.calls == 3:
+                started.set()
+                release.wait(5)
+            running.remove(self)
+
+    sleep_mock.return_value = False
+
+    maker = watch(lambda: [
+        coffee('smoke.js', ['wood.coffee']),
+        coffee('smoke.min.js', 'smoke.js'),
+    ], database=None)
+    eq_(coffee.calls, 2)
+
+    maker.watcher.change_handler(Observation('wood.coffee', 'modified'))
+    maker.process_changes()
+    assert started.wait(5)
+    for i in range(3):
+        maker.watcher.change_handler(Observation('wood.coffee', 'modified'))
+        maker.process_changes()
+    release.set()
+    maker.executor.wait()
+
+    # smoke.js runs once more after the running build, and smoke.min.js once after that
+    eq_(coffee.calls, 5)
+    eq_(overlapped, [])
+
+    close(maker)
+    maker.watcher.stop()
+
+
+@mock.patch.object(Maker, 'close')   # don't let it shutdown yet
+@mock.patch.object(Maker, 'sleep')
+def test_watch_atomic_save(sleep_mock, close_mock):
+    # editors replacing a source while saving rebuild it instead of reloading
+    class coffee(Compiler):
+        run = MagicMock()
+
+    sleep_mock.return_value = False
+
+    maker = watch(lambda: [
+        coffee('smoke.js', ['wood.coffee']),
+        coffee('fire.js', ['fire.coffee']),
+    ], database=None)
+    eq_(coffee.run.call_count, 2)
+
+    # vim
+    for obs in [Observation('wood.coffee', 'deleted'), Observation('wood.coffee', 'created'),
+                Observation('wood.coffee', 'modified')]:
+        maker.watcher.change_handler(obs)
+    # a temporary file renamed over the original
+    for obs in [Observation('.fire.coffee.tmp', 'created'), Observation('.fire.coffee.tmp', 'deleted'),
+                Observation('fire.coffee', 'created')]:
+        maker.watcher.change_handler(obs)
+    eq_(maker.process_changes(), None)
+    maker.executor.wait()
+    eq_(coffee.run.call_count, 4)
+
+    # a new file still reloads
+    maker.watcher.change_handler(Observation('water.coffee', 'created'))
+    eq_(maker.process_changes(), Maker.RELOAD)
+
+    close(maker)
+    maker.watcher.stop()
+
+
+@mock.patch.object(Maker, 'close')   # don't let it shutdown yet
+@mock.patch.object(Maker, 'sleep')
+def test_watch_atomic_save_reload(sleep_mock, close_mock):
+    # a source saved by renaming over it still matches its glob after a reload
+    class coffee(Compiler):
+        run = MagicMock()
+
+    sleep_mock.return_value = False
+    with temporary_directory() as directory:
+        js = os.path.join(directory, 'js')
+        a, b, c = [os.path.join(js, name + '.coffee') for name in 'abc']
+        write(a)
+        write(b)
+
+        def tasks():
+            return [coffee(os.path.join(directory, 'all.js'), os.path.join(js, '*.coffee'))]
+
+        maker = watch(tasks, directory=directory, database=None)
+        try:
+            for obs in [Observation(a, 'deleted'), Observation(a, 'created')]:
+                maker.watcher.change_handler(obs)
+            eq_(maker.process_changes(), None)
+
+            write(c)
+            maker.watcher.change_handler(Observation(c, 'created'))
+            eq_(maker.process_changes(), Maker.RELOAD)
+            maker.reload(tasks())
+            maker.executor.wait()
+            eq_(list(maker.tasks[0].dependent), [a, b, c])
+        finally:
+            close(maker)
+            maker.watcher.stop()
+
+
+@mock.patch.object(Maker, 'close')   # don't let it shutdown yet
+@mock.patch.object(Maker, 'sleep')
+def test_watch_reload_with_edit(sleep_mock, close_mock):
+    # an edit in the same batch as a new file is built after the reload
+    built = []
+
+    class coffee(Compiler):
+        def run(self):
+            built.append(self.output_file)
+
+    sleep_mock.return_value = False
+    tasks = [coffee('smoke.js', ['wood.coffee'])]
+    maker = watch(lambda: list(tasks), database=None)
+    eq_(built, ['smoke.js'])
+
+    maker.watcher.change_handler(Observation('wood.coffee', 'modified'))
+    maker.watcher.change_handler(Observation('water.coffee', 'created'))
+    eq_(maker.process_changes(), Maker.RELOAD)
+    tasks.append(coffee('water.js', ['water.coffee']))
+    maker.reload(list(tasks))
+    maker.executor.wait()
+    eq_(sorted(built), ['smoke.js', 'smoke.js', 'water.js'])
+
+    close(maker)
+    maker.watcher.stop()
+
+
+@mock.patch.object(Maker, 'close')   # don't let it shutdown yet
+@mock.patch.object(Maker, 'sleep')
+def test_watch_coalesce_upstream(sleep_mock, close_mock):
+    # a run replaced while its dependency runs still waits for that dependency
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    class coffee(Compiler):
+        def run(self):
+            if self.output_file == 'smoke.js' and len(order) == 2:
+                started.set()
+                release.wait(5)
+            order.append(self.output_file)
+
+    sleep_mock.return_value = False
+
+    maker = watch(lambda: [
+        coffee('smoke.js', ['wood.coffee']),
+        coffee('smoke.min.js', ['smoke.js', 'fire.coffee']),
+    ], database=None, jobs=4)
+    eq_(order, ['smoke.js', 'smoke.min.js'])
+
+    maker.watcher.change_handler(Observation('wood.coffee', 'modified'))
+    maker.process_changes()
+    assert started.wait(5)
+    # only smoke.min.js is rebuilt for this one, replacing the run waiting for smoke.js
+    maker.watcher.change_handler(Observation('fire.coffee', 'modified'))
+    maker.process_changes()
+    release.set()
+    maker.executor.wait()
+    eq_(order, ['smoke.js', 'smoke.min.js', 'smoke.js', 'smoke.min.js'])
+
+    close(maker)
+    maker.watcher.stop()
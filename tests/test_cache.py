@@ -0,0 +1,98 @@
+import os
+from nose.tools import eq_
+from chimney.api import make
+from chimney.cache import ArtifactCache, DirectoryBackend
+from tests.fixtures import concat, temporary_directory, write
+
+
+class mapped(concat):
+    # written over the declared source when the run starts, like an editor saving meanwhile
+    edit = None
+
+    def run(self):
+        if mapped.edit is not None:
+            write(self.dependent[0], mapped.edit)
+        super(mapped, self).run()
+        sources = list(self.sources()) + self.discover()
+        write(self.output_file + '.map', u','.join(os.path.basename(s) for s in sources))
+
+    def discover(self):
+        partial = os.path.join(os.path.dirname(self.output_file), '_partial.coffee')
+        return [partial] if os.path.exists(partial) else []
+
+    def outputs(self):
+        return [self.output_file, self.output_file + '.map']
+
+
+def checkout(root, name, files):
+    directory = os.path.join(root, name)
+    for filename, data in files.items():
+        write(os.path.join(directory, filename), data)
+    return directory
+
+
+def test_cache():
+    with temporary_directory() as root:
+        cache = os.path.join(root, 'cache')
+
+        def build(directory, **kwargs):
+            runs = concat.runs
+            make(mapped(os.path.join(directory, 'smoke.js'), [os.path.join(directory, 'wood.coffee')]),
+                 directory=directory, cache=cache, **kwargs)
+            with open(os.path.join(directory, 'smoke.js'), 'rb') as f:
+                return concat.runs - runs, f.read()
+
+        def source_map(directory):
+            with open(os.path.join(directory, 'smoke.js.map'), 'rb') as f:
+                return f.read()
+
+        files = {'wood.coffee': b'wood', '_partial.coffee': b'+fire'}
+        eq_(build(checkout(root, 'one', files)), (1, b'wood+fire'))
+
+        # another checkout, somewhere else and without a database, gets the output from the cache
+        eq_(build(checkout(root, 'two', files), database=None), (0, b'wood+fire'))
+        # along with the source map written next to it
+        eq_(source_map(os.path.join(root, 'two')), b'wood.coffee,_partial.coffee')
+
+        # a different discovered input isn't a hit
+        eq_(build(checkout(root, 'three', dict(files, **{'_partial.coffee': b'+water'}))), (1, b'wood+water'))
+        # neither is a different declared one
+        eq_(build(checkout(root, 'four', dict(files, **{'wood.coffee': b'oak'}))), (1, b'oak+fire'))
+
+        # an input edited while the task runs doesn't file the output under its old contents
+        for wood, kwargs in [(b'elm', {}), (b'yew', {'database': None})]:
+            edits = dict(files, **{'wood.coffee': wood})
+            mapped.edit = b'ash'
+            try:
+                eq_(build(checkout(root, 'edited-' + wood, edits), **kwargs), (1, b'ash+fire'))
+            finally:
+                mapped.edit = None
+            eq_(build(checkout(root, 'clean-' + wood, edits), **kwargs), (1, wood + b'+fire'))
+
+
+def test_directory_backend():
+    with temporary_directory() as root:
+        output = os.path.join(root, 'out', 'smoke.js')
+        source = os.path.join(root, 'smoke.js')
+        write(source, b'smoke')
+
+        for link in (False, True):
+            backend = DirectoryBackend(os.path.join(root, 'cache-{0}'.format(link)), link=link)
+            eq_(backend.read('abcdef'), None)
+            eq_(backend.fetch('abcdef', output), False)
+
+            backend.write('abcdef', b'{}')
+            backend.store('012345', source)
+            eq_(backend.read('abcdef'), b'{}')
+            eq_(backend.fetch('012345', output), True)
+            with open(output, 'rb') as f:
+                eq_(f.read(), b'smoke')
+            eq_(os.stat(output).st_nlink, 2 if link else 1)
+            umask = os.umask(0)
+            os.umask(umask)
+            eq_(os.stat(output).st_mode & 0o777, 0o666 & ~umask)
+            eq_(sorted(os.listdir(os.path.dirname(output))), ['smoke.js'])
+
+        cache = ArtifactCache(os.path.join(root, 'cache'), root)
+        eq_(cache.backend.root, os.path.join(root, 'cache'))
+        eq_(cache.relative(output), 'out/smoke.js')
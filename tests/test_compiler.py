@@ -1,6 +1,14 @@
+import os
+import sys
+import threading
+import time
 from nose.tools import eq_, assert_raises
 from chimney import flags
-from chimney.compilers import Compiler, uglify
+from chimney.api import Maker, make
+from chimney.compilers import Compiler, CompilerError, local, uglify
+from chimney.scheduler import Runner
+from chimney.workers import WorkerError, WorkerPool
+from tests.fixtures import temporary_directory, write
 
 
 def test_extra_flags():
@@ -19,3 +27,160 @@ def test_uglify_flags():
     eq_(c.extra_flags['--source-map'], 'b.map')
 
     eq_(c.get_flags(), ['--source-map b.map'])
+    eq_(c.outputs(), ['b', 'b.map'])
+    eq_(uglify('b', 'a').outputs(), ['b'])
+
+
+class pid(Compiler):
+    def run(self):
+        with open(self.output_file, 'wb') as f:
+            f.write(str(os.getpid()).encode('ascii'))
+
+
+class mapped(Compiler):
+    def run(self):
+        for output in self.outputs():
+            write(output, b'smoke')
+
+    def outputs(self):
+        return [self.output_file, self.output_file + '.map']
+
+
+def test_side_outputs():
+    with temporary_directory() as directory:
+        smoke = os.path.join(directory, 'smoke.js')
+        task = mapped(smoke, [])
+        maker = Maker(task, directory=directory, database=None)
+        eq_(maker.outputs(), set([smoke, smoke + '.map']))
+        eq_(maker.stats.stat(smoke + '.map'), None)
+
+        # every file the task wrote is stat'ed again
+        task.run()
+        task.built(None, time.time())
+        eq_(maker.stats.stat(smoke + '.map').st_size, 5)
+        maker.close()
+
+
+class fails(Compiler):
+    process = True
+
+    def run(self):
+        raise CompilerError(['false'], 1, '', 'failed')
+
+
+def test_process_executor():
+    with temporary_directory() as directory:
+        output = os.path.join(directory, 'pid')
+        make(pid(output, __file__), directory=directory, executor='process')
+        with open(output, 'rb') as f:
+            assert int(f.read()) != os.getpid(), 'task should run in a worker process'
+
+
+class forked(Compiler):
+    def run(self):
+        pool = self.maker._process_pool
+        forked.processes = len(pool._processes) if pool is not None else 0
+        with open(self.output_file, 'wb') as f:
+            f.write(b'')
+
+
+def test_process_started_first():
+    # worker processes are forked before any thread runs a task
+    with temporary_directory() as directory:
+        first = forked(os.path.join(directory, 'first'), __file__)
+        second = pid(os.path.join(directory, 'second'), first.output_file)
+        second.process = True
+        make(first, second, directory=directory, database=None, jobs=2)
+        eq_(forked.processes, 2)
+
+
+def test_process_error():
+    with temporary_directory() as directory:
+        task = fails(os.path.join(directory, 'out'), __file__)
+        maker = Maker(task, directory=directory)
+        runner = Runner(task)
+        runner.schedule(maker.executor)
+        maker.executor.wait()
+        maker.close()
+
+        e = runner.future.exception()
+        assert isinstance(e, CompilerError)
+        eq_(e.stderr, 'failed')
+
+
+class echo(Compiler):
+    worker = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker_stub.py')]
+
+    def run(self):
+        stdout, stderr = self.execute_command(['echo'] + list(self.sources()))
+        self.stdout = stdout
+
+
+def test_persistent_worker():
+    with temporary_directory() as directory:
+        maker = Maker(directory=directory, jobs=2)
+        a = echo('a', 'a.txt', maker=maker)
+        b = echo('b', ['b.txt', 'c.txt'], maker=maker)
+        a.run()
+        b.run()
+
+        pid, args = a.stdout.split(b' ', 1)
+        eq_(args, b'a.txt')
+        # the same worker handled both
+        eq_(b.stdout, pid + b' b.txt c.txt')
+
+        with assert_raises(CompilerError) as cm:
+            a.execute_command(['echo', 'fail'])
+        eq_(cm.exception.stderr, b'failed')
+        maker.close()
+
+
+def test_worker_pool_close():
+    # workers in the middle of a request are killed instead of left running
+    pool = WorkerPool(2)
+    errors = []
+
+    def hang():
+        try:
+            pool.execute(echo.worker, ['echo', 'hang'])
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=hang)
+    thread.start()
+    while not pool.workers:
+        time.sleep(.01)
+    pool.execute(echo.worker, ['echo', 'idle'])
+    eq_(len(pool.workers), 2)
+    workers = list(pool.workers)
+
+    pool.close()
+    thread.join(10)
+    assert not thread.is_alive()
+    eq_([w.alive() for w in workers], [False, False])
+    eq_(len(errors), 1)
+    with assert_raises(WorkerError):
+        pool.execute(echo.worker, ['echo', 'late'])
+
+
+def test_local_output():
+    with temporary_directory() as directory:
+        output = os.path.join(directory, 'out.js')
+        stdout, stderr = local([sys.executable, '-c', 'print("x" * 200000)'], output=output)
+        eq_(stdout, None)
+        with open(output, 'rb') as f:
+            eq_(f.read().strip(), b'x' * 200000)
+        # the same permissions as any new file
+        reference = os.path.join(directory, 'reference')
+        open(reference, 'wb').close()
+        eq_(os.stat(output).st_mode, os.stat(reference).st_mode)
+        os.remove(reference)
+
+        # a failure leaves the previous output alone and keeps only the end of stderr
+        with assert_raises(CompilerError) as cm:
+            local([sys.executable, '-c', 'import sys; print("partial"); '
+                   'sys.stderr.write("e" * 200000 + "end"); sys.exit(1)'], output=output)
+        assert len(cm.exception.stderr) < 200000
+        assert cm.exception.stderr.endswith(b'end')
+        with open(output, 'rb') as f:
+            eq_(f.read().strip(), b'x' * 200000)
+        eq_(os.listdir(directory), ['out.js'])
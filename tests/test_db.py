@@ -0,0 +1,173 @@
+import os
+from mock import Mock, patch
+from nose.tools import eq_
+from chimney.api import Maker, make, plan
+from chimney.compilers import Compiler
+from chimney.db import BuildDatabase
+from tests.fixtures import concat, temporary_directory, write
+
+
+def test_content_changes():
+    with temporary_directory() as directory:
+        wood = os.path.join(directory, 'wood.coffee')
+        smoke = os.path.join(directory, 'smoke.js')
+        write(wood, b'wood')
+
+        def build(**kwargs):
+            make(concat(smoke, [wood], **kwargs), directory=directory)
+
+        concat.runs = 0
+        build()
+        eq_(concat.runs, 1)
+
+        # nothing changed
+        build()
+        eq_(concat.runs, 1)
+
+        # a new mtime with the same contents is not a change
+        st = os.stat(wood)
+        os.utime(wood, (st.st_atime, st.st_mtime + 10))
+        build()
+        eq_(concat.runs, 1)
+
+        write(wood, b'more wood')
+        build()
+        eq_(concat.runs, 2)
+
+        # different flags
+        build(extra_flags={'--bare': ''})
+        eq_(concat.runs, 3)
+
+        # the output was changed by something else
+        write(smoke, b'ash')
+        build(extra_flags={'--bare': ''})
+        eq_(concat.runs, 4)
+
+
+def test_database_round_trip():
+    with temporary_directory() as directory:
+        filename = os.path.join(directory, '.chimney', 'db')
+        source = os.path.join(directory, 'a')
+        write(source, b'a')
+
+        db = BuildDatabase(filename)
+        task = Compiler(os.path.join(directory, 'b'), source)
+        reason, inputs = db.check(task)
+        eq_(reason, 'no previous build')
+        db.record(task, inputs)
+        db.save()
+
+        db = BuildDatabase(filename)
+        eq_(db.check(task), ('missing output', inputs))
+
+
+class strip(Compiler):
+    runs = 0
+
+    def run(self):
+        strip.runs += 1
+        with open(self.output_file, 'wb') as out:
+            for source in self.sources():
+                with open(source, 'rb') as f:
+                    out.write(f.read().strip())
+
+
+def test_early_cutoff():
+    with temporary_directory() as directory:
+        wood = os.path.join(directory, 'wood.coffee')
+        smoke = os.path.join(directory, 'smoke.js')
+        write(wood, b'wood')
+
+        first = strip(smoke, [wood])
+        second = concat(os.path.join(directory, 'smoke.min.js'), [smoke])
+        second.build = Mock(wraps=second.build)
+        maker = Maker(first, second, directory=directory)
+        maker.load(maker.tasks)
+
+        def rebuild():
+            maker.schedule(maker.scheduler.run(maker.scheduler.targets.downstream([first]), [first]))
+            maker.executor.wait()
+
+        strip.runs = concat.runs = 0
+        maker.execute()
+        eq_((strip.runs, concat.runs), (1, 1))
+
+        # the same output doesn't rebuild anything downstream
+        write(wood, b'wood\n')
+        rebuild()
+        eq_((strip.runs, concat.runs), (2, 1))
+        eq_(second.build.call_count, 1, 'smoke.min.js should not be built')
+
+        write(wood, b'more wood')
+        rebuild()
+        eq_((strip.runs, concat.runs), (3, 2))
+
+        # an unchanged dependency doesn't skip a task whose own output is gone
+        os.remove(os.path.join(directory, 'smoke.min.js'))
+        write(wood, b'more wood\n')
+        rebuild()
+        eq_((strip.runs, concat.runs), (4, 3))
+        maker.close()
+
+
+def test_stat_once():
+    # a build with nothing to do stats every file once, however many tasks use it
+    with temporary_directory() as directory:
+        vendor = os.path.join(directory, 'vendor.js')
+        sources = [os.path.join(directory, '{0}.coffee'.format(i)) for i in range(3)]
+        for filename in [vendor] + sources:
+            write(filename, b'wood')
+
+        def tasks():
+            built = [concat(source[:-len('.coffee')] + '.js', [vendor, source]) for source in sources]
+            return built + [concat(os.path.join(directory, 'all.js'), [t.output_file for t in built])]
+
+        for database in (os.path.join(directory, 'db'), None):
+            make(*tasks(), directory=directory, database=database)
+            maker = Maker(*tasks(), directory=directory, database=database)
+            runs = concat.runs
+            with patch('os.stat', wraps=os.stat) as stat:
+                maker.execute()
+            maker.close()
+            eq_(concat.runs, runs)
+            # the vendor file, the sources and their outputs and all.js
+            eq_(len(set(c[0][0] for c in stat.call_args_list)), 1 + len(sources) * 2 + 1)
+            eq_(stat.call_count, 1 + len(sources) * 2 + 1)
+
+
+def test_plan():
+    with temporary_directory() as directory:
+        wood = os.path.join(directory, 'wood.coffee')
+        smoke = os.path.join(directory, 'smoke.js')
+        ash = os.path.join(directory, 'ash.js')
+        write(wood, b'wood')
+
+        def tasks():
+            return concat(smoke, [wood]), concat(ash, [smoke])
+
+        for database in (os.path.join(directory, 'db'), None):
+            os.utime(wood, (0, 0))
+            first = plan(*tasks(), directory=directory, database=database)
+            eq_([(t.output_file, reason) for t, reason in first], [
+                (smoke, u'no previous build' if database else u'missing output'),
+                (ash, u'{0} will be rebuilt'.format(smoke)),
+            ])
+            # planning doesn't create a database
+            eq_(database and os.path.exists(database), False if database else None)
+            runs = concat.runs
+            make(*tasks(), directory=directory, database=database)
+            eq_(concat.runs, runs + 2)
+
+            # nothing ran while planning
+            eq_(plan(*tasks(), directory=directory, database=database), [])
+            write(wood, b'more wood')
+            os.utime(wood, (os.path.getmtime(smoke) + 10,) * 2)
+            saved = database and open(database, 'rb').read()
+            eq_([(t.output_file, reason) for t, reason in plan(*tasks(), directory=directory, database=database)], [
+                (smoke, u'changed {0}'.format(wood)),
+                (ash, u'{0} will be rebuilt'.format(smoke)),
+            ])
+            # or change one, even though the new digest of wood.coffee was computed
+            eq_(database and open(database, 'rb').read(), saved)
+            os.remove(smoke)
+            os.remove(ash)
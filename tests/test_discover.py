@@ -0,0 +1,78 @@
+import os
+from nose.tools import eq_
+from chimney import discover
+from chimney.api import Maker
+from chimney.compilers import Compiler
+from tests.fixtures import temporary_directory, write
+
+
+def test_depfile():
+    with temporary_directory() as directory:
+        filename = os.path.join(directory, 'out.d')
+        write(filename, u'out.js: a.js \\\n  lib/b.js my\\ file.js\nc.js:\n')
+        eq_(discover.depfile(filename), ['a.js', 'lib/b.js', 'my file.js'])
+        eq_(discover.depfile(os.path.join(directory, 'missing.d')), [])
+
+
+def test_source_map():
+    with temporary_directory() as directory:
+        filename = os.path.join(directory, 'out.js.map')
+        write(filename, u'{"version": 3, "sourceRoot": "src", "sources": ["a.coffee", "http://x/b.js"]}')
+        eq_(discover.source_map(filename), [os.path.join(directory, 'src', 'a.coffee')])
+
+
+def test_imports():
+    with temporary_directory() as directory:
+        main = os.path.join(directory, 'main.scss')
+        write(main, u'@import "lib/colors", "reset.css";\n@import url(http://fonts/x.css);\nbody {}')
+        write(os.path.join(directory, 'lib', '_colors.scss'), u'@import "mixins";')
+        write(os.path.join(directory, 'lib', 'mixins.scss'), u'@import "colors";')
+        write(os.path.join(directory, 'reset.css'), u'')
+
+        eq_(sorted(discover.imports([main])), [
+            os.path.join(directory, 'lib', '_colors.scss'),
+            os.path.join(directory, 'lib', 'mixins.scss'),
+            os.path.join(directory, 'reset.css'),
+        ])
+
+
+class scss(Compiler):
+    runs = 0
+
+    def run(self):
+        scss.runs += 1
+        write(self.output_file, u'')
+
+    def discover(self):
+        return discover.imports(list(self.sources()))
+
+
+def test_discovered_inputs():
+    with temporary_directory() as directory:
+        main = os.path.join(directory, 'main.scss')
+        partial = os.path.join(directory, '_partial.scss')
+        write(main, u'@import "partial";')
+        write(partial, u'')
+        task = scss(os.path.join(directory, 'main.css'), main)
+
+        scss.runs = 0
+        maker = Maker(task, directory=directory)
+        maker.load(maker.tasks)
+        maker.schedule(maker.scheduler.run())
+        maker.executor.wait()
+        maker.update_discovered()
+        eq_(scss.runs, 1)
+        eq_(maker.by_source[partial], set([task]))
+        eq_(maker.scheduler.targets.sources(task), [main, partial])
+        maker.close()
+
+        # the partial is remembered by the next build and changes to it rebuild the task
+        maker = Maker(scss(os.path.join(directory, 'main.css'), main), directory=directory)
+        maker.load(maker.tasks)
+        assert partial in maker.by_source, 'discovered inputs should be loaded from the database'
+        maker.execute()
+        eq_(scss.runs, 1)
+        write(partial, u'body {}')
+        maker.execute()
+        eq_(scss.runs, 2)
+        maker.close()
@@ -0,0 +1,96 @@
+import os
+from mock import patch
+from nose.tools import eq_
+from chimney.api import Maker
+from chimney.compilers import Compiler
+from chimney.index import DirectoryIndex, StatCache
+from tests.fixtures import temporary_directory, write
+
+
+def test_glob():
+    with temporary_directory() as directory:
+        for name in ['js/a.coffee', 'js/b.js', 'js/lib/c.coffee', 'js/lib/deep/d.coffee', 'js/.e.coffee']:
+            write(os.path.join(directory, name))
+
+        index = DirectoryIndex()
+        js = os.path.join(directory, 'js')
+        eq_(index.glob(js + '/*.coffee'), [os.path.join(js, 'a.coffee')])
+        eq_(index.glob(js + '/**/*.coffee'), [
+            os.path.join(js, 'a.coffee'),
+            os.path.join(js, 'lib', 'c.coffee'),
+            os.path.join(js, 'lib', 'deep', 'd.coffee'),
+        ])
+        eq_(index.glob(js + '/*/c.*'), [os.path.join(js, 'lib', 'c.coffee')])
+        eq_(index.glob(js + '/missing/*.js'), [])
+
+
+def test_update():
+    with temporary_directory() as directory:
+        write(os.path.join(directory, 'a.coffee'))
+        index = DirectoryIndex()
+        pattern = os.path.join(directory, '*.coffee')
+        eq_(len(index.glob(pattern)), 1)
+
+        created = os.path.join(directory, 'b.coffee')
+        write(created)
+        with patch.object(index, 'read') as read:
+            index.update(created, 'created')
+            eq_(index.glob(pattern), [os.path.join(directory, 'a.coffee'), created])
+
+            os.remove(created)
+            index.update(created, 'deleted')
+            eq_(index.glob(pattern), [os.path.join(directory, 'a.coffee')])
+            eq_(read.call_count, 0)
+
+
+def test_compiler_patterns():
+    with temporary_directory() as directory:
+        for name in ['a.coffee', 'b.coffee', 'c.js']:
+            write(os.path.join(directory, name))
+
+        maker = Maker(directory=directory, database=None)
+        with patch.object(DirectoryIndex, 'read', autospec=True, side_effect=DirectoryIndex.read) as read:
+            one = Compiler('one.js', os.path.join(directory, '*.coffee'), maker=maker)
+            two = Compiler('two.js', [os.path.join(directory, '*.*'), lambda: ['extra.js']], maker=maker)
+            eq_(one.dependent, [os.path.join(directory, 'a.coffee'), os.path.join(directory, 'b.coffee')])
+            eq_(two.dependent, [
+                os.path.join(directory, 'a.coffee'),
+                os.path.join(directory, 'b.coffee'),
+                os.path.join(directory, 'c.js'),
+                'extra.js',
+            ])
+            # both patterns share one listing of the directory
+            eq_(read.call_count, 1)
+        maker.close()
+
+
+def test_stat_cache():
+    stats = StatCache()
+    here = os.path.relpath(__file__)
+    size = os.path.getsize(here)
+    with patch('os.stat', wraps=os.stat) as stat:
+        stats.prefetch([here, here, os.path.join('.', here), 'missing.js'])
+        eq_(stat.call_count, 2)
+        eq_(stats.stat(here).st_size, size)
+        eq_(stats.stat('missing.js'), None)
+        eq_(stat.call_count, 2)
+
+        stats.forget(here)
+        stats.stat(here)
+        eq_(stat.call_count, 3)
+
+
+def test_stat_cache_forget_while_stating():
+    stats = StatCache()
+    here = os.path.relpath(__file__)
+    real = os.stat
+
+    def stat(filename):
+        # a task writes the file and forgets it while it is being stat'ed
+        stats.forget(filename)
+        return real(filename)
+
+    with patch('os.stat', side_effect=stat) as mock:
+        stats.prefetch([here])
+        stats.stat(here)
+        eq_(mock.call_count, 2)
@@ -0,0 +1,68 @@
+import os
+import sys
+import threading
+from nose.tools import eq_
+from chimney.api import Maker
+from chimney.compilers import Command, Compiler
+from chimney.jobserver import JobServer, strip_jobserver
+from tests.fixtures import temporary_directory
+
+
+def test_tokens():
+    jobserver = JobServer.create(3)
+    try:
+        tokens = [jobserver.acquire() for i in range(3)]
+        eq_(tokens, [None, b'+', b'+'])
+
+        # all three jobs are taken, so the next one waits for a release
+        acquired = []
+        t = threading.Thread(target=lambda: acquired.append(jobserver.acquire()))
+        t.daemon = True
+        t.start()
+        t.join(.1)
+        eq_(acquired, [])
+
+        jobserver.release(tokens.pop())
+        t.join(1)
+        eq_(acquired, [b'+'])
+        jobserver.release(tokens.pop(0))
+        eq_(jobserver.acquire(), None)
+    finally:
+        jobserver.close()
+
+
+def test_makeflags():
+    eq_(strip_jobserver('s -j4 --jobserver-fds=3,4 --jobserver-auth=3,4 --no-print-directory'),
+        's --no-print-directory')
+
+    jobserver = JobServer.create(2)
+    try:
+        environ = jobserver.environ({'MAKEFLAGS': 'k'})
+        auth = '{0},{1}'.format(jobserver.read_fd, jobserver.write_fd)
+        eq_(environ['MAKEFLAGS'], jobserver.makeflags)
+        assert '--jobserver-auth=' + auth in environ['MAKEFLAGS']
+
+        child = JobServer.from_environ(environ)
+        eq_((child.read_fd, child.write_fd), (jobserver.read_fd, jobserver.write_fd))
+        eq_(JobServer.from_environ({'MAKEFLAGS': 'k'}), None)
+        eq_(JobServer.from_environ({'MAKEFLAGS': '--jobserver-auth=1000,1001'}), None)
+    finally:
+        jobserver.close()
+
+
+class makeflags(Compiler):
+    def commands(self):
+        yield Command([sys.executable, '-c', 'import os; print(os.environ.get("MAKEFLAGS"))'],
+                      output=self.output_file)
+
+
+def test_children():
+    with temporary_directory() as directory:
+        output = os.path.join(directory, 'flags')
+        maker = Maker(makeflags(output, __file__), directory=directory, database=None, jobs=2, jobserver=True)
+        maker.execute()
+        with open(output, 'rb') as f:
+            assert b'--jobserver-auth=' in f.read(), 'children should find the jobserver'
+        # every token is back
+        eq_([maker.jobserver.acquire() for i in range(2)], [None, b'+'])
+        maker.close()
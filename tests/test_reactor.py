@@ -0,0 +1,107 @@
+import os
+import sys
+import threading
+from nose.tools import eq_
+from chimney.api import Maker
+from chimney.compilers import Command, Compiler, CompilerError
+from chimney.reactor import CommandReactor
+from chimney.scheduler import Runner
+from tests.fixtures import temporary_directory, write
+
+
+class copy(Compiler):
+    threads = set()
+
+    def commands(self):
+        copy.threads.add(threading.current_thread().name)
+        script = 'import sys; sys.stdout.write(open(sys.argv[1]).read() + "!")'
+        stdout, stderr = yield Command([sys.executable, '-c', script] + list(self.sources()), output=self.output_file)
+        eq_(stdout, None)
+
+
+class cat(Compiler):
+    runs = 0
+
+    def commands(self):
+        cat.runs += 1
+        yield Command(['cat'] + list(self.sources()), output=self.output_file)
+
+
+class fails(Compiler):
+    def commands(self):
+        yield Command([sys.executable, '-c', 'import sys; sys.stderr.write("oops"); sys.exit(3)'],
+                      output=self.output_file)
+
+
+def test_reactor():
+    reactor = CommandReactor(2)
+    results = []
+    done = threading.Event()
+
+    def callback(result=None, error=None):
+        results.append(result or error)
+        if len(results) == 5:
+            done.set()
+
+    for i in range(5):
+        reactor.submit(Command([sys.executable, '-c', 'print({0})'.format(i)]), callback)
+    done.wait(10)
+    reactor.close()
+    eq_(sorted(stdout.strip() for stdout, stderr in results), [b'0', b'1', b'2', b'3', b'4'])
+
+
+def test_async_build():
+    with temporary_directory() as directory:
+        source = os.path.join(directory, 'a')
+        write(source, b'a')
+
+        copy.threads = set()
+        tasks = [copy(os.path.join(directory, 'b'), source), copy(os.path.join(directory, 'c'), os.path.join(directory, 'b'))]
+        maker = Maker(*tasks, directory=directory, executor='async', jobs=2)
+        maker.execute()
+        maker.close()
+        with open(os.path.join(directory, 'c'), 'rb') as f:
+            eq_(f.read(), b'a!!')
+        # nothing but the reactor thread steps through commands
+        eq_(copy.threads, set(['CommandReactor']))
+
+
+def test_async_long_chain():
+    # up to date tasks finish without recursing into the ones depending on them
+    with temporary_directory() as directory:
+        files = [os.path.join(directory, '{0}.txt'.format(i)) for i in range(sys.getrecursionlimit() // 4)]
+        write(files[0], b'wood')
+
+        for runs in (len(files) - 1, 0):
+            cat.runs = 0
+            maker = Maker(*[cat(files[i + 1], files[i]) for i in range(len(files) - 1)],
+                          directory=directory, executor='async')
+            t = threading.Thread(target=maker.execute)
+            t.daemon = True
+            t.start()
+            t.join(60)
+            assert not t.is_alive(), 'the build should finish'
+            maker.close()
+            eq_(cat.runs, runs)
+        with open(files[-1], 'rb') as f:
+            eq_(f.read(), b'wood')
+
+
+def test_async_failure():
+    with temporary_directory() as directory:
+        output = os.path.join(directory, 'b')
+        task = fails(output, __file__)
+        maker = Maker(task, directory=directory, executor='async', database=None)
+        runner = Runner(task)
+        downstream = Runner(copy(os.path.join(directory, 'c'), output, maker=maker))
+        downstream.waiting_for.append(runner)
+        downstream.schedule(maker.executor)
+        runner.schedule(maker.executor)
+        maker.executor.wait()
+        maker.close()
+
+        e = runner.future.exception()
+        assert isinstance(e, CompilerError)
+        eq_((e.returncode, e.stderr), (3, b'oops'))
+        assert downstream.future.cancelled(), 'tasks depending on a failure should not run'
+        assert not os.path.exists(output), 'a failed command should not leave an output'
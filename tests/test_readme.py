@@ -19,6 +19,7 @@ def test_smoke():
 
     chimney.make(
         compiler('smoke.js', ['wood.coffee', 'fire.coffee']),
+        database=None,
     )
 
     assert compiler.ran, 'compiler not executed'
@@ -37,6 +38,7 @@ def test_combine():
     chimney.make(
         coffee('smoke.js', ['wood.coffee', 'fire.coffee']),
         uglify('smoke.min.js', 'smoke.js'),
+        database=None,
     )
 
     assert coffee.run.called
@@ -60,7 +62,7 @@ def test_watch(sleep_mock, close_mock):
             uglify('smoke.min.js', 'smoke.js'),
         ]
 
-    maker = chimney.watch(create_tasks, reload_patterns=['*.coffee', '*.js'])
+    maker = chimney.watch(create_tasks, reload_patterns=['*.coffee', '*.js'], database=None)
 
     eq_(coffee.run.call_count, 1)
     eq_(uglify.run.call_count, 1)
@@ -68,10 +70,12 @@ def test_watch(sleep_mock, close_mock):
     maker.watcher.change_handler(Observation('wood.coffee', 'modified'))
     maker.process_changes()
     maker.executor.wait()
+    # smoke.min.js is rebuilt from the new smoke.js
     eq_(coffee.run.call_count, 2)
-    eq_(uglify.run.call_count, 1)
+    eq_(uglify.run.call_count, 2)
 
     maker.watcher.change_handler(Observation('smoke.js', 'modified'))
     maker.process_changes()
     maker.executor.wait()
-    eq_(uglify.run.call_count, 2)
+    eq_(coffee.run.call_count, 2)
+    eq_(uglify.run.call_count, 3)
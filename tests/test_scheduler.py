@@ -1,11 +1,14 @@
+import threading
+import time
 from pprint import pprint
 from concurrent.futures import _base
 from mock import MagicMock
 from mock import Mock
-from nose.tools import eq_
+from nose.tools import eq_, assert_raises
 from chimney.api import Maker
-from chimney.scheduler import TaskGraph, Runner, Scheduler
+from chimney.scheduler import TaskGraph, Runner, Scheduler, CyclicDependencyError
 from chimney.compilers import coffee, uglify, Compiler
+from chimney.executor import DelayedThreadPoolExecutor
 
 
 class MockExecutor(_base.Executor):
@@ -72,7 +75,7 @@ def test_base():
     runners = Scheduler().load(tasks).run()
     eq_(len(runners['static/js-c/home/signed_in.min.js'].waiting_for), 5)
 
-    maker = Maker(*tasks)
+    maker = Maker(*tasks, database=None)
     maker.executor = MockExecutor()
     maker.execute()
 
@@ -106,3 +109,172 @@ def test_runner():
     assert runner_b.future.done(), 'b should have run'
     runner_c.schedule(executor)
     assert runner_c.future.done(), 'c should have run'
+
+
+def test_runner_submits_once():
+    executor = MockExecutor()
+    runner_a = Runner(Mock())
+    runner_b = Runner(Mock())
+    runner_b.waiting_for += [runner_a, runner_a]
+
+    runner_b.schedule(executor)
+    runner_b.schedule(executor)
+    runner_a.schedule(executor)
+    eq_(executor.executed, [runner_a, runner_b])
+
+
+def test_runner_dependency_failed():
+    executor = MockExecutor()
+    runner_a = Runner(Mock())
+    runner_b = Runner(Mock())
+    runner_c = Runner(Mock())
+    runner_b.waiting_for.append(runner_a)
+    runner_c.waiting_for.append(runner_b)
+
+    runner_c.schedule(executor)
+    runner_b.schedule(executor)
+    runner_a.future.set_exception(ValueError())
+    assert runner_b.future.cancelled(), 'b should be cancelled'
+    assert runner_c.future.cancelled(), 'c should be cancelled'
+    eq_(executor.executed, [])
+
+
+def test_runner_take_over():
+    executor = MockExecutor()
+    upstream = Runner(Mock(output_file='a.js'))
+    changed = Runner(Mock(output_file='b.js'))
+    retried = Runner(Mock(output_file='c.js'))
+    previous = Runner(Mock(output_file='d.js'))
+    previous.cutoff = True
+    previous.waiting_for += [upstream, changed, retried]
+    previous.schedule(executor)
+    changed.future.set_result(True)
+    assert previous.replace()
+
+    # c.js is built again by a newer runner, a.js is still running
+    again = Runner(Mock(output_file='c.js'))
+    runner = Runner(previous.task)
+    runner.cutoff = True
+    runner.waiting_for.append(again)
+    runner.take_over(previous, {'c.js': again, 'd.js': runner})
+    runner.schedule(executor)
+
+    retried.future.set_exception(ValueError())
+    again.future.set_result(False)
+    assert not runner.future.done(), 'should wait for a.js'
+    upstream.future.set_result(False)
+    # b.js changed for the replaced runner, so it isn't cut off
+    assert previous.future.cancelled()
+    eq_(executor.executed, [runner])
+
+
+def test_graph_cycle():
+    graph = TaskGraph()
+    graph.arc(coffee('a.js', ['a.coffee', 'c.js']))
+    graph.arc(coffee('b.js', ['a.js']))
+    graph.arc(coffee('c.js', ['b.js']))
+    graph.arc(coffee('d.js', ['d.coffee']))
+
+    with assert_raises(CyclicDependencyError) as cm:
+        list(graph.toposort())
+    eq_(cm.exception.cycle, ['a.js', 'c.js', 'b.js', 'a.js'])
+
+
+def test_graph_upstream():
+    graph = TaskGraph()
+    tasks = [
+        coffee('one.js', ['one.coffee']),
+        coffee('two.js', ['two.coffee']),
+        uglify('one.min.js', ['one.js']),
+        uglify('all.min.js', ['one.js', 'two.js']),
+    ]
+    for task in tasks:
+        graph.arc(task)
+
+    eq_(graph.upstream(['./one.min.js']), [tasks[2], tasks[0]])
+    eq_(set(graph.upstream(['all.min.js', 'one.min.js'])), set(tasks))
+    with assert_raises(ValueError):
+        graph.upstream(['missing.js'])
+
+
+def test_graph_deep_chain():
+    graph = TaskGraph()
+    tasks = [Compiler('0.js', 'src.js')]
+    tasks += [Compiler('{0}.js'.format(i), '{0}.js'.format(i - 1)) for i in range(1, 5000)]
+    for task in reversed(tasks):
+        graph.arc(task)
+
+    eq_(list(graph.toposort()), tasks)
+
+
+def test_priority():
+    tasks = [
+        coffee('a.js', 'a.coffee'),
+        uglify('a.min.js', 'a.js'),
+        coffee('b.js', 'b.coffee'),
+        coffee('c.js', 'c.coffee'),
+    ]
+    runners = Scheduler(durations={'a.js': 1.0, 'a.min.js': 4.0, 'b.js': 3.0}).load(tasks).run()
+
+    # the a chain is longest, c has never run and counts as average
+    eq_(runners['a.js'].priority, 5.0)
+    eq_(runners['a.min.js'].priority, 4.0)
+    eq_(runners['b.js'].priority, 3.0)
+    eq_(runners['c.js'].priority, 8.0 / 3)
+
+
+def test_executor_priority():
+    executor = DelayedThreadPoolExecutor(1)
+    started = []
+    blocked = threading.Event()
+
+    def runner(name, priority):
+        def task():
+            blocked.wait()
+            started.append(name)
+        r = Runner(task)
+        r.priority = priority
+        return r
+
+    # first goes first however soon the worker starts, then blocks it until the rest are queued
+    for name, priority in [('first', 10), ('low', 1), ('high', 5), ('same', 1)]:
+        executor.submit(runner(name, priority))
+    blocked.set()
+    executor.wait()
+    executor.shutdown()
+    eq_(started, ['first', 'high', 'low', 'same'])
+
+
+def test_executor_resources():
+    executor = DelayedThreadPoolExecutor(4, resources={'memory': 500})
+    running = []
+    peak = []
+    lock = threading.Lock()
+    order = []
+
+    class task(object):
+        def __init__(self, name, resources):
+            self.name = name
+            self.resources = resources
+
+        def __call__(self):
+            with lock:
+                running.append(self)
+                order.append(self.name)
+                peak.append(sum(t.resources.get('memory', 0) for t in running))
+            time.sleep(.05)
+            with lock:
+                running.remove(self)
+
+    for i in range(3):
+        r = Runner(task('heavy{0}'.format(i), {'memory': 300}))
+        r.priority = 10
+        executor.submit(r)
+    for i in range(3):
+        executor.submit(Runner(task('light{0}'.format(i), {})))
+    executor.wait()
+    executor.shutdown()
+
+    eq_(max(peak), 300)
+    # light tasks fill the slots the heavy ones can't use
+    assert order.index('light0') < order.index('heavy1'), order
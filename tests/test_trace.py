@@ -0,0 +1,43 @@
+import json
+import os
+from nose.tools import eq_
+from chimney.api import make
+from chimney.compilers import Compiler
+from chimney.executor import DelayedThreadPoolExecutor
+from chimney.trace import Tracer
+from tests.fixtures import temporary_directory, write
+
+
+class touch(Compiler):
+    def run(self):
+        write(self.output_file, b'')
+
+
+def test_trace():
+    with temporary_directory() as directory:
+        trace = os.path.join(directory, 'build.json')
+        a = os.path.join(directory, 'a.js')
+        b = os.path.join(directory, 'b.js')
+        make(touch(a, __file__), touch(b, a), directory=directory, trace=trace)
+
+        with open(trace, 'rb') as f:
+            events = json.loads(f.read().decode('utf-8'))['traceEvents']
+
+        tasks = [e['name'] for e in events if e.get('cat') == 'task' and e['name'] in (a, b)]
+        eq_(tasks, [a, b])
+        eq_(len([e for e in events if e['name'] == 'check']), 2)
+        eq_(len([e for e in events if e['name'] == 'run']), 2)
+
+        # both waited in the queue, b waited for a too
+        eq_(sorted(e['name'] for e in events if e.get('cat') == 'queue' and e['ph'] == 'b'), [a, b])
+        eq_([e['name'] for e in events if e.get('cat') == 'dependencies' and e['ph'] == 'b'], [b])
+        assert all(e['dur'] >= 0 for e in events if e['ph'] == 'X')
+
+
+def test_executor_start_keeps_tracer():
+    executor = DelayedThreadPoolExecutor(1)
+    tracer = Tracer()
+    executor.tracer = tracer
+    executor.start()
+    assert executor.tracer is tracer
+    executor.shutdown()
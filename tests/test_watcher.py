@@ -1,8 +1,14 @@
 import os
+import select
 import shutil
+import threading
 import time
+from mock import patch
 from nose.tools import eq_
-from chimney.watch import Watcher, Observation
+from watchdog.events import FileModifiedEvent, FileMovedEvent
+from chimney.compilers import temporary
+from chimney.watch import ChangeQueue, Watcher, Observation, net_changes, watch_directories
+from tests.fixtures import temporary_directory, write
 
 
 def test_watcher():
@@ -37,6 +43,29 @@ def test_watcher():
         shutil.rmtree(watched, ignore_errors=True)
 
 
+def test_watcher_new_directories():
+    with temporary_directory() as watched:
+        events = []
+        watcher = Watcher(events.append, path=[watched], recursive=False, include=['*.coffee'])
+        try:
+            # a subdirectory of a subdirectory, with a file in it before it can be watched
+            os.makedirs(os.path.join(watched, 'a', 'b'))
+            wood = os.path.join(watched, 'a', 'b', 'wood.coffee')
+            write(wood, b'wood')
+
+            deadline = time.time() + 5
+            while os.path.join(watched, 'a', 'b') not in watcher.watches and time.time() < deadline:
+                time.sleep(.01)
+            fire = os.path.join(watched, 'a', 'b', 'fire.coffee')
+            write(fire, b'fire')
+            while fire not in [obs.path for obs in events] and time.time() < deadline:
+                time.sleep(.01)
+
+            eq_(set(obs.path for obs in net_changes(events) if obs.type == 'created'), set([wood, fire]))
+        finally:
+            watcher.stop()
+
+
 def test_hash_observation():
     changes = [
         Observation('one.js', 'modified'),
@@ -45,3 +74,117 @@ def test_hash_observation():
     ]
 
     eq_([c.path for c in set(changes)], ['one.js', 'two.js'])
+
+
+def test_change_queue():
+    changes = ChangeQueue()
+    eq_(changes.wait(timeout=.01), False)
+
+    def burst():
+        for i in range(5):
+            changes.put(Observation('{0}.js'.format(i), 'modified'))
+            time.sleep(.01)
+    t = threading.Thread(target=burst)
+    t.start()
+
+    # the whole burst arrives as one batch
+    eq_(changes.wait(timeout=1, debounce=.1), True)
+    eq_([c.path for c in changes.drain()], ['0.js', '1.js', '2.js', '3.js', '4.js'])
+    eq_(len(changes), 0)
+    t.join()
+
+
+def test_change_queue_idle():
+    # waiting doesn't wake up until something changes
+    changes = ChangeQueue()
+    with patch('select.select', wraps=select.select) as wakeups:
+        eq_(changes.wait(timeout=.3), False)
+        eq_(wakeups.call_count, 1)
+
+        t = threading.Timer(.1, changes.put, [Observation('wood.coffee', 'modified')])
+        t.start()
+        eq_(changes.wait(), True)
+        eq_(wakeups.call_count, 2)
+        t.join()
+    changes.close()
+
+
+def test_watcher_filters():
+    here = os.path.dirname(os.path.abspath(__file__))
+    events = []
+    watcher = Watcher(events.append, path=[here], recursive=False,
+                      include=['*.coffee', '*.js'], exclude=['node_modules/*'],
+                      ignore=set([os.path.abspath('smoke.js')]))
+    try:
+        for filename in ['wood.coffee', 'smoke.js', 'smoke.min.js', 'node_modules/x.js', 'README.md']:
+            watcher.on_any_event(FileModifiedEvent(filename))
+        eq_([obs.path for obs in events], ['wood.coffee', 'smoke.min.js'])
+    finally:
+        watcher.stop()
+
+
+def test_watcher_ignores_temporary_files():
+    with temporary_directory() as directory:
+        smoke = os.path.join(directory, 'smoke.js')
+        watcher = Watcher(lambda obs: None, path=[directory], recursive=False, ignore=set([smoke]))
+        try:
+            # the files atomic_write replaces an output with
+            fd, tmp = temporary(smoke)
+            os.close(fd)
+            eq_(watcher.accept(tmp), False)
+            fd, tmp = temporary(os.path.join(directory, 'wood.coffee'))
+            os.close(fd)
+            eq_(watcher.accept(tmp), True)
+            eq_(watcher.accept(os.path.join(directory, '.smoke.js.tmp')), True)
+        finally:
+            watcher.stop()
+
+
+def test_watcher_moved():
+    here = os.path.dirname(os.path.abspath(__file__))
+    events = []
+    watcher = Watcher(events.append, path=[here], recursive=False, exclude=['*~'])
+    try:
+        watcher.on_any_event(FileMovedEvent('wood.coffee', 'wood.coffee~'))
+        watcher.on_any_event(FileMovedEvent('.wood.coffee.tmp', 'wood.coffee'))
+        eq_(events, [
+            Observation('wood.coffee', 'deleted'),
+            Observation('.wood.coffee.tmp', 'deleted'),
+            Observation('wood.coffee', 'created'),
+        ])
+    finally:
+        watcher.stop()
+
+
+def test_net_changes():
+    changes = net_changes([
+        # vim
+        Observation('wood.coffee', 'deleted'),
+        Observation('wood.coffee', 'created'),
+        Observation('wood.coffee', 'modified'),
+        # a temporary file renamed over the original
+        Observation('.fire.coffee.tmp', 'created'),
+        Observation('.fire.coffee.tmp', 'modified'),
+        Observation('.fire.coffee.tmp', 'deleted'),
+        Observation('fire.coffee', 'created'),
+        Observation('new.coffee', 'created'),
+        Observation('new.coffee', 'modified'),
+        Observation('old.coffee', 'modified'),
+        Observation('old.coffee', 'deleted'),
+    ])
+    eq_(sorted((obs.path, obs.type) for obs in changes), [
+        ('fire.coffee', 'created'),
+        ('new.coffee', 'created'),
+        ('old.coffee', 'deleted'),
+        ('wood.coffee', 'modified'),
+    ])
+
+
+def test_watch_directories():
+    here = os.path.dirname(os.path.abspath(__file__))
+    eq_(watch_directories([
+        os.path.join(here, 'a.coffee'),
+        os.path.join(here, 'b.coffee'),
+        os.path.join(here, 'missing', 'c.coffee'),
+        __file__,
+    ]), [here])
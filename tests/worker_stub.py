@@ -0,0 +1,33 @@
+"""
+A persistent worker for tests. Echoes its arguments and process id, fails if the first
+argument is "fail" or never answers if it is "hang".
+"""
+import json
+import os
+import sys
+import time
+
+
+def main():
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+
+        request = json.loads(line)
+        arguments = request['arguments']
+        response = {'request_id': request['request_id'], 'exit_code': 0, 'stdout': '', 'stderr': ''}
+        if arguments and arguments[0] == 'hang':
+            time.sleep(60)
+        if arguments and arguments[0] == 'fail':
+            response['exit_code'] = 1
+            response['stderr'] = 'failed'
+        else:
+            response['stdout'] = u'{0} {1}'.format(os.getpid(), ' '.join(arguments))
+
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()